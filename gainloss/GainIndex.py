@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+
+
+class GainIndex:
+    """
+    Tax gain/loss rows of the whole history sorted by sale date, with prefix sums of proceeds, cost and
+    short and long term gains per currency. The totals of any date range take two binary searches,
+    rows are a slice of the sorted report.
+    """
+
+    TAX_DATE_FMT = '%m/%d/%Y'
+    SUMS = ['Proceeds', 'Cost', 'Short Term Gain', 'Long Term Gain', 'Gain or Loss']
+    QUERY_COLUMNS = ['Start', 'End', 'Currency'] + SUMS
+
+    def __init__(self, tax_rows):
+        """
+
+        :param tax_rows: tax gain/loss rows by currency, e.g. MatchLedger.tax_rows
+        :type tax_rows: dict
+        """
+        self.rows_by_currency = {}
+        self.dates = {}
+        self.prefix = {}
+
+        for currency, tax in tax_rows.items():
+            tax = tax.assign(**{'Tran DT': pd.to_datetime(tax['Tran DT'])})
+            tax = tax.sort_values(by='Tran DT', kind='stable', ignore_index=True)
+
+            long_term = GainIndex.long_term(tax).values
+            gain = tax['Gain or Loss'].values
+            sums = np.column_stack([tax['Proceeds'].values, tax['Cost'].values,
+                                    np.where(long_term, 0, gain), np.where(long_term, gain, 0), gain])
+
+            self.rows_by_currency[currency] = tax
+            self.dates[currency] = tax['Tran DT']
+            # row i holds the sums of the first i tax rows, missing values are skipped as pandas sums do
+            self.prefix[currency] = np.vstack([np.zeros((1, len(GainIndex.SUMS))),
+                                               np.cumsum(np.nan_to_num(sums), axis=0)])
+
+    @property
+    def currencies(self):
+        return list(self.rows_by_currency)
+
+    def totals(self, start, end, currency=None):
+        """
+        Totals of the rows sold between start and end, both included
+        :param currency: all currencies if None
+        :return: proceeds, cost, short and long term gain and gain or loss, rounded to cents
+        :rtype: dict
+        """
+        totals = np.zeros(len(GainIndex.SUMS))
+        for cur in self.__currencies(currency):
+            lo, hi = self.__bounds(cur, start, end)
+            totals += self.prefix[cur][hi] - self.prefix[cur][lo]
+
+        return dict(zip(GainIndex.SUMS, (round(t, 2) for t in totals)))
+
+    def rows(self, start, end, currency=None):
+        """
+        Tax gain/loss rows sold between start and end, both included, in the order they were sold
+        :rtype: pd.DataFrame
+        """
+        rows = []
+        for cur in self.__currencies(currency):
+            lo, hi = self.__bounds(cur, start, end)
+            rows.append(self.rows_by_currency[cur].iloc[lo:hi])
+
+        if len(rows) == 1:
+            return rows[0]
+
+        return pd.concat(rows, ignore_index=True).sort_values(by='Tran DT', kind='stable', ignore_index=True)
+
+    def query(self, windows, currency=None):
+        """
+        Totals of several date ranges, e.g. the quarters of estimated taxes
+        :param windows: (start, end) pairs
+        :rtype: pd.DataFrame
+        """
+        return pd.DataFrame([dict(self.totals(start, end, currency), Start=start, End=end, Currency=currency or 'ALL')
+                             for start, end in windows], columns=GainIndex.QUERY_COLUMNS)
+
+    @staticmethod
+    def long_term(tax):
+        """
+        Rows of lots held for more than a year
+        """
+        return (pd.to_datetime(tax['Date Sold'], format=GainIndex.TAX_DATE_FMT) >
+                pd.to_datetime(tax['Date Aquired'], format=GainIndex.TAX_DATE_FMT) + pd.DateOffset(years=1))
+
+    def __currencies(self, currency):
+        if currency is None:
+            return self.currencies
+
+        if currency not in self.rows_by_currency:
+            raise KeyError('{c} is not indexed'.format(c=currency))
+        return [currency]
+
+    def __bounds(self, currency, start, end):
+        dates = self.dates[currency]
+        return (dates.searchsorted(GainIndex.__timestamp(start, dates), side='left'),
+                dates.searchsorted(GainIndex.__timestamp(end, dates), side='right'))
+
+    @staticmethod
+    def __timestamp(date, dates):
+        """
+        The date in the time zone of the index, a naive date is taken to be in it
+        """
+        date = pd.Timestamp(date)
+        tz = getattr(dates.dtype, 'tz', None)
+
+        if date.tzinfo is None and tz is not None:
+            return date.tz_localize(tz)
+        if date.tzinfo is not None and tz is None:
+            return date.tz_convert(None)
+        return date
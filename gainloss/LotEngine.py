@@ -0,0 +1,243 @@
+import heapq
+from collections import defaultdict, deque
+
+import pandas as pd
+
+from Tran import Tran, GDAX_CLMN, UNITS
+from Storage import CsvStorage
+
+
+class FifoLots:
+    """
+    Open lots of one currency in a double-ended queue, the oldest lot is sold first
+    """
+
+    def __init__(self):
+        self.queue = deque()
+
+    def append(self, lot):
+        self.queue.append(lot)
+
+    def peek(self):
+        return self.queue[0]
+
+    def pop(self):
+        self.queue.popleft()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __iter__(self):
+        return iter(self.queue)
+
+
+class LifoLots(FifoLots):
+    """
+    The newest lot is sold first
+    """
+
+    def peek(self):
+        return self.queue[-1]
+
+    def pop(self):
+        self.queue.pop()
+
+
+class HifoLots:
+    """
+    Open lots of one currency in a heap keyed by the USD unit cost, the most expensive lot is sold first.
+    Lots of the same cost are sold oldest first.
+    """
+
+    SIGN = -1
+
+    def __init__(self):
+        self.heap = []
+        self.added = 0
+
+    def append(self, lot):
+        heapq.heappush(self.heap, (self.SIGN * lot.buy.usd_unit_price, self.added, lot))
+        self.added += 1
+
+    def peek(self):
+        return self.heap[0][2]
+
+    def pop(self):
+        heapq.heappop(self.heap)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self):
+        # purchase order, so a checkpoint restores the same tie order
+        return (lot for cost, added, lot in sorted(self.heap, key=lambda entry: entry[1]))
+
+
+class LofoLots(HifoLots):
+    """
+    The cheapest lot is sold first
+    """
+
+    SIGN = 1
+
+
+class LotEngine:
+    """
+    Keeps open (not yet sold) lots per currency in an index picked by the lot selection method:
+    a double-ended queue for FIFO/LIFO and a cost-keyed heap for HIFO/LOFO, so the next lot
+    of a sell is found without scanning the whole purchase history.
+    """
+
+    FIFO = 'fifo'
+    LIFO = 'lifo'
+    HIFO = 'hifo'
+    LOFO = 'lofo'
+
+    METHODS = {
+        FIFO: FifoLots,
+        LIFO: LifoLots,
+        HIFO: HifoLots,
+        LOFO: LofoLots
+    }
+
+    CLM_Currency = 'currency'
+    CLM_Vol = 'vol'
+    CLM_UsdUnitPrice = 'usd unit price'
+    CLM_UsdTotal = 'usd total'
+
+    CHECKPOINT_COLUMNS = [
+        GDAX_CLMN.TradeId,
+        GDAX_CLMN.CreatedAt,
+        CLM_Currency,
+        GDAX_CLMN.Size,
+        CLM_Vol,
+        CLM_UsdUnitPrice,
+        CLM_UsdTotal,
+        GDAX_CLMN.Fee,
+        GDAX_CLMN.TradeUnit,
+        GDAX_CLMN.ADV_TradeUnitPrice
+    ]
+
+    def __init__(self, method=FIFO, as_of=None):
+        """
+
+        :param method: lot selection method, one of METHODS
+        :param as_of: date of the checkpoint the lots were restored from, later transactions only are matched
+        """
+        if method not in LotEngine.METHODS:
+            raise ValueError('unknown lot selection method {m}, use one of {ms}'.format(
+                m=method, ms=', '.join(LotEngine.METHODS)))
+
+        self.method = method
+        self.as_of = as_of
+        self.lots = defaultdict(LotEngine.METHODS[method])
+        self.balances = defaultdict(int)
+        self.consumed = 0
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint, as_of, method=FIFO):
+        """
+        :param checkpoint: open lots as returned by checkpoint()
+        :type checkpoint: pd.DataFrame
+        :param as_of: period end the checkpoint was taken at
+        :param method: lot selection method
+        """
+        engine = cls(method, as_of)
+
+        for row in checkpoint[LotEngine.CHECKPOINT_COLUMNS].itertuples(index=False):
+            engine.add(Tran.open_lot(*row))
+
+        return engine
+
+    def checkpoint(self, currency):
+        """
+        Open lots of the currency in purchase order: volume, USD cost, remaining fee and acquired date
+        :rtype: pd.DataFrame
+        """
+        return pd.DataFrame([[lot.trade_id, lot.created_at, currency, lot.size, lot.buy.vol, lot.buy.usd_unit_price,
+                              lot.buy.usd_total_price, lot.fee, lot.price_fee_total_unit, lot.gdax_trade_unit_price]
+                             for lot in self.open_lots(currency)],
+                            columns=LotEngine.CHECKPOINT_COLUMNS)
+
+    @staticmethod
+    def write_checkpoint(checkpoint, path):
+        """
+        Lots of Coinbase exports are bought on whole seconds, GDAX ones on fractions: all dates get one format
+        """
+        checkpoint.to_csv(path, index=False, date_format=CsvStorage.DATE_FORMAT)
+
+    @staticmethod
+    def read_checkpoint(path):
+        checkpoint = pd.read_csv(path, float_precision='round_trip')
+        checkpoint[GDAX_CLMN.CreatedAt] = pd.to_datetime(checkpoint[GDAX_CLMN.CreatedAt], utc=True, format='ISO8601')
+        return checkpoint
+
+    def add(self, tran):
+        """
+        Registers the bought side of the transaction as a new open lot
+        :param tran:
+        :type tran: Tran
+        """
+        self.lots[tran.buy_currency()].append(tran)
+        self.balances[tran.buy_currency()] += tran.buy.units
+
+    def balance(self, currency):
+        return self.balances[currency] / UNITS
+
+    def open_lots(self, currency):
+        return [lot for lot in self.lots[currency] if lot.buy.units > 0]
+
+    def consume(self, currency, sell_units):
+        """
+        Takes ``sell_units`` (an integer count of UNIT) out of the open lots of ``currency``, in the order
+        of the lot selection method. Volumes are matched as integers, so the sell is used up exactly.
+
+        Yields (lot, vol, usd_unit_price, usd_total, usd_fee) for every lot slice used. The lot
+        itself is reduced only once the caller asks for the next slice, so the yielded lot still
+        reflects its state before the sale and the generator has to be exhausted.
+        """
+        lots = self.lots[currency]
+
+        while lots:
+            prev_buy = lots.peek()
+            buy = prev_buy.buy
+
+            if buy.units <= 0:
+                lots.pop()
+                continue
+
+            if sell_units >= buy.units:
+                units = buy.units
+                sell_units -= units
+
+                self.consumed += 1
+                yield prev_buy, units / UNITS, buy.usd_unit_price, buy.usd_total_price, prev_buy.tran_usd_fee()
+
+                buy.units = 0
+                buy.usd_total_price = 0
+                lots.pop()
+                self.balances[currency] -= units
+
+                if sell_units == 0:
+                    return
+            else:
+                sell_amount = sell_units / UNITS
+                prise_per_coin = buy.usd_unit_price
+                total_for_partial_tran = round(sell_amount * prise_per_coin, 8)
+                partial_fee = 0
+                partial_fee_units = 0
+
+                if prev_buy.tran_usd_fee() > 0:  # apply just a part of the fee
+                    partial_sell_ratio = sell_units / buy.units
+                    partial_fee = round(partial_sell_ratio * prev_buy.tran_usd_fee(), 8)
+                    # fee share rounded half up to a whole unit
+                    partial_fee_units = (2 * sell_units * prev_buy.fee_units + buy.units) // (2 * buy.units)
+
+                self.consumed += 1
+                yield prev_buy, sell_amount, prise_per_coin, total_for_partial_tran, partial_fee
+
+                prev_buy.fee_units -= partial_fee_units
+                buy.units -= sell_units
+                buy.usd_total_price = round(buy.vol * prise_per_coin, 2)
+                self.balances[currency] -= sell_units
+                return
@@ -0,0 +1,145 @@
+from array import array
+
+import numpy as np
+import pandas as pd
+
+from Tran import round_to
+
+
+class MatchLedger:
+    """
+    Columnar record of lot matching: a row per sell and a row per lot slice used by a sell.
+    Gains, info strings and tax rows are derived from it in bulk, and only when asked for.
+    """
+
+    TAX_DATE_FMT = '%m/%d/%Y'
+
+    def __init__(self):
+        # sells
+        self.sell_rows = array('q')
+        self.sell_dates = []
+        self.sell_usd_total = array('d')
+        self.sell_usd_unit_price = array('d')
+        self.sell_usd_fee = array('d')
+        self.sell_usd_fee_rate = array('d')
+        self.sell_size = array('d')
+
+        # lot slices
+        self.sell_no = array('q')
+        self.buy_dates = []
+        self.vol = array('d')
+        self.price = array('d')
+        self.total = array('d')
+        self.fee = array('d')
+        # LotEngine gives the fee of a partly used lot without any fee as the int 0, info prints it as such
+        self.int_fee = array('b')
+        self.buy_usd_fee_rate = array('d')
+        self.buy_size = array('d')
+
+    def __len__(self):
+        return len(self.sell_rows)
+
+    def sell(self, row, tran):
+        """
+        Records a sell, the lot slices matched to it follow with match()
+        :param row: position of the sell in the report
+        :type tran: Tran
+        """
+        self.sell_rows.append(row)
+        self.sell_dates.append(tran.created_at)
+        self.sell_usd_total.append(tran.sell.usd_total_price)
+        self.sell_usd_unit_price.append(tran.sell.usd_unit_price)
+        self.sell_usd_fee.append(tran.tran_usd_fee())
+        self.sell_usd_fee_rate.append(MatchLedger.usd_fee_rate(tran))
+        self.sell_size.append(tran.size)
+
+    def match(self, lot, vol, price, total, fee):
+        """
+        Records a slice of the lot used by the last sell, as yielded by LotEngine.consume
+        """
+        self.sell_no.append(len(self.sell_rows) - 1)
+        self.buy_dates.append(lot.created_at)
+        self.vol.append(vol)
+        self.price.append(price)
+        self.total.append(total)
+        self.fee.append(fee)
+        self.int_fee.append(isinstance(fee, int))
+        self.buy_usd_fee_rate.append(MatchLedger.usd_fee_rate(lot))
+        self.buy_size.append(lot.size)
+
+    @staticmethod
+    def usd_fee_rate(tran):
+        """
+        Fee of the whole transaction in USD, Tran.tran_usd_fee(vol) is this times vol / size
+        """
+        return tran.fee if tran.is_usd_unit() else tran.fee * tran.gdax_trade_unit_price
+
+    def gains(self):
+        """
+        :return: gain/loss of every sell rounded to cents, the sale fee included
+        """
+        sell_no = np.frombuffer(self.sell_no, dtype=np.int64)
+        cost = np.bincount(sell_no, weights=self.total, minlength=len(self))
+        fee = np.bincount(sell_no, weights=self.fee, minlength=len(self))
+
+        return round_to(np.asarray(self.sell_usd_total) - cost - fee - np.asarray(self.sell_usd_fee), 2)
+
+    def info(self):
+        """
+        :return: 'vol@price/total,fee:fee;' of every slice and the sale fee, a string per sell
+        """
+        slices = pd.Series(MatchLedger.strings(self.vol) + '@' + MatchLedger.strings(self.price) + '/' +
+                           MatchLedger.strings(self.total) + ',fee:' + self.fee_strings() + ';')
+
+        info = slices.groupby(np.frombuffer(self.sell_no, dtype=np.int64)).agg(''.join)
+        info = info.reindex(range(len(self)), fill_value='')
+
+        sale_fee = np.asarray(self.sell_usd_fee)
+        return np.where(sale_fee > 0, info.values + ' sale_fee:' + MatchLedger.strings(sale_fee), info.values)
+
+    def tax_rows(self, currency):
+        """
+        Form 8949 like rows, one per lot slice with non zero proceeds
+        :rtype: pd.DataFrame
+        """
+        sell_no = np.frombuffer(self.sell_no, dtype=np.int64)
+        vol = np.asarray(self.vol)
+        decimals = 2 if currency == 'USD' else 8
+
+        sell_size = np.asarray(self.sell_size)[sell_no]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            proceeds = (round_to(np.asarray(self.sell_usd_unit_price)[sell_no] * vol, decimals) +
+                        np.asarray(self.sell_usd_fee_rate)[sell_no] * (vol / sell_size))
+            cost = (round_to(np.asarray(self.price) * vol, decimals) -
+                    np.asarray(self.buy_usd_fee_rate) * (vol / np.asarray(self.buy_size)))
+
+        sold = pd.Series(self.sell_dates, dtype=object)[sell_no].reset_index(drop=True)
+        acquired = pd.Series(self.buy_dates, dtype=object)
+
+        rows = pd.DataFrame({
+            'Description': MatchLedger.strings(vol) + ' ' + currency,
+            'Date Aquired': MatchLedger.tax_dates(acquired),
+            'Date Sold': MatchLedger.tax_dates(sold),
+            'Proceeds': round_to(proceeds, 2),
+            'Cost': round_to(cost, 2),
+            'Gain or Loss': round_to(proceeds - cost, 2),
+            'Tran DT': pd.to_datetime(sold) if len(sold) else sold
+        })
+
+        return rows[rows['Proceeds'] != 0].reset_index(drop=True)
+
+    def fee_strings(self):
+        fee = np.asarray(self.fee, dtype=float)
+        return np.where(np.frombuffer(self.int_fee, dtype=np.int8).astype(bool),
+                        fee.astype(np.int64).astype(str).astype(object), MatchLedger.strings(fee))
+
+    @staticmethod
+    def strings(values):
+        """
+        Floats formatted the way str() does it, nan included
+        """
+        return np.asarray(values, dtype=float).astype(str).astype(object)
+
+    @staticmethod
+    def tax_dates(dates):
+        return pd.to_datetime(dates).dt.strftime(MatchLedger.TAX_DATE_FMT) if len(dates) else dates
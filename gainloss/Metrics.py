@@ -0,0 +1,112 @@
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+
+class Metrics:
+    """
+    Stage timers, counters and optional cProfile hooks for one pipeline run
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers = defaultdict(lambda: {'calls': 0, 'seconds': 0.0})
+        self.counters = defaultdict(float)
+        self.profiles = {}
+        self.profiled_stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block under the stage name, the block is profiled if profile() was asked for it
+        """
+        profiler = None
+        if name in self.profiled_stages:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+
+            if profiler:
+                profiler.disable()
+                self.__store_profile(name, profiler)
+
+            with self._lock:
+                self.timers[name]['calls'] += 1
+                self.timers[name]['seconds'] += elapsed
+
+    def timed(self, name):
+        def decorate(func):
+            @wraps(func)
+            def timed_function(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+
+            return timed_function
+
+        return decorate
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def profile(self, name, sort='cumulative', limit=30):
+        """
+        Turns on cProfile for every following run of the named stage
+        """
+        self.profiled_stages[name] = (sort, limit)
+
+    def merge(self, snapshot):
+        """
+        Adds timers and counters collected elsewhere, e.g. in a worker process
+        """
+        with self._lock:
+            for name, timer in snapshot['timers'].items():
+                self.timers[name]['calls'] += timer['calls']
+                self.timers[name]['seconds'] += timer['seconds']
+            for name, value in snapshot['counters'].items():
+                self.counters[name] += value
+            self.profiles.update(snapshot.get('profiles', {}))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'timers': {name: dict(timer, seconds=round(timer['seconds'], 6)) for name, timer in self.timers.items()},
+                'counters': {name: round(value, 6) if isinstance(value, float) and not value.is_integer() else int(value)
+                             for name, value in self.counters.items()},
+                'profiles': dict(self.profiles)
+            }
+
+    def reset(self):
+        with self._lock:
+            self.timers.clear()
+            self.counters.clear()
+            self.profiles.clear()
+
+    def to_json(self, path=None):
+        summary = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+        if path:
+            with open(path, 'w') as f:
+                f.write(summary)
+        return summary
+
+    def __store_profile(self, name, profiler):
+        sort, limit = self.profiled_stages[name]
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats(sort).print_stats(limit)
+
+        with self._lock:
+            self.profiles[name] = self.profiles.get(name, '') + out.getvalue()
+
+
+metrics = Metrics()
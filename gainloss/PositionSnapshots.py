@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+
+class PositionSnapshots:
+    """
+    Open positions of a currency at a sorted list of dates, taken while the lots are matched:
+    the lots are recorded right before the first transaction later than each date.
+    """
+
+    CLM_Date = 'Date'
+    CLM_Currency = 'Currency'
+    CLM_Lots = 'Lots'
+    CLM_Vol = 'Vol'
+    CLM_Cost = 'Cost'
+    CLM_Price = 'Price'
+    CLM_Value = 'Value'
+    CLM_Unrealized = 'Unrealized Gain'
+
+    COLUMNS = [CLM_Date, CLM_Currency, CLM_Lots, CLM_Vol, CLM_Cost, CLM_Price, CLM_Value, CLM_Unrealized]
+
+    def __init__(self, currency, dates):
+        """
+
+        :param dates: snapshot dates, UTC if naive
+        """
+        self.currency = currency
+        self.dates = pd.to_datetime(pd.Series(dates), utc=True).sort_values(ignore_index=True)
+        self.bounds = list(self.dates)
+        self.taken = 0
+        self.lots = []
+        self.vol = []
+        self.cost = []
+
+    def take(self, lots, until=None):
+        """
+        Records the open lots for every date before until, all remaining dates if None
+        :type lots: LotEngine
+        """
+        while self.taken < len(self.bounds) and (until is None or self.bounds[self.taken] < until):
+            open_lots = lots.open_lots(self.currency)
+
+            self.lots.append(len(open_lots))
+            self.vol.append(lots.balance(self.currency))
+            self.cost.append(round(np.nansum([lot.buy.usd_total_price for lot in open_lots]), 2))
+            self.taken += 1
+
+    def positions(self, prices=None):
+        """
+        :param prices: USD price of the currency at every date, unrealized gains are nan if None
+        :return: a row per date
+        :rtype: pd.DataFrame
+        """
+        price = np.full(len(self.dates), np.nan) if prices is None else np.asarray(prices, dtype=float)
+        value = np.round(np.asarray(self.vol) * price, 2)
+
+        return pd.DataFrame({
+            PositionSnapshots.CLM_Date: self.dates,
+            PositionSnapshots.CLM_Currency: self.currency,
+            PositionSnapshots.CLM_Lots: self.lots,
+            PositionSnapshots.CLM_Vol: self.vol,
+            PositionSnapshots.CLM_Cost: self.cost,
+            PositionSnapshots.CLM_Price: price,
+            PositionSnapshots.CLM_Value: value,
+            PositionSnapshots.CLM_Unrealized: np.round(value - np.asarray(self.cost), 2)
+        }, columns=PositionSnapshots.COLUMNS)
@@ -0,0 +1,213 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from Metrics import metrics
+
+
+class PriceCache:
+    """
+    Two tier cache of historical USD prices: an in-memory LRU in front of a SQLite file.
+    Prices are keyed by (currency, minute bucket, window), so a repeated run never asks
+    GDAX again for a price it has already seen. Pages of candles, as the batched enrichment
+    loads them, are kept in the same file keyed by (currency, page start, granularity).
+    """
+
+    EVICT_EVERY = 1000
+
+    def __init__(self, path='./data/price_cache.sqlite', memory_size=10000, max_rows=1000000, max_pages=10000):
+        """
+
+        :param path: SQLite file, None or ':memory:' keeps everything in memory
+        :param memory_size: max number of prices held in the LRU tier
+        :param max_rows: max number of prices stored on disk, least recently used are evicted first
+        :param max_pages: max number of candle pages stored on disk
+        """
+        self.memory_size = memory_size
+        self.max_rows = max_rows
+        self.max_pages = max_pages
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.page_hits = 0
+        self.page_misses = 0
+
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._clock = 0
+        # LRU times of disk hits, written with the next put instead of holding a write transaction open on reads
+        self._touched = {}
+
+        if path and path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.db = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS prices ('
+                        'currency TEXT NOT NULL, minute INTEGER NOT NULL, window INTEGER NOT NULL, '
+                        'price REAL NOT NULL, used INTEGER NOT NULL, '
+                        'PRIMARY KEY (currency, minute, window))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS prices_used ON prices (used)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS candles ('
+                        'currency TEXT NOT NULL, start INTEGER NOT NULL, granularity INTEGER NOT NULL, '
+                        'candles TEXT NOT NULL, used INTEGER NOT NULL, '
+                        'PRIMARY KEY (currency, start, granularity))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS candles_used ON candles (used)')
+        self._clock = self.db.execute('SELECT MAX(COALESCE((SELECT MAX(used) FROM prices), 0), '
+                                      'COALESCE((SELECT MAX(used) FROM candles), 0))').fetchone()[0]
+
+    @staticmethod
+    def key(currency, date, window):
+        return currency, int(date.timestamp() // 60), int(window)
+
+    @staticmethod
+    def page_key(currency, start, granularity):
+        return currency, int(start.timestamp()), int(granularity)
+
+    def get(self, currency, date, window):
+        key = PriceCache.key(currency, date, window)
+
+        with self._lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                metrics.count('price_cache_hits')
+                return self.memory[key]
+
+            row = self.db.execute('SELECT price FROM prices WHERE currency=? AND minute=? AND window=?',
+                                  key).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.count('price_cache_misses')
+                return None
+
+            self.hits += 1
+            self.disk_hits += 1
+            metrics.count('price_cache_hits')
+            self._touch('prices', key)
+            self._remember(key, row[0])
+            return row[0]
+
+    def put(self, currency, date, window, price):
+        key = PriceCache.key(currency, date, window)
+
+        with self._lock:
+            self._clock += 1
+            self._write_touched()
+            self.db.execute('INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?, ?)', key + (price, self._clock))
+            self.db.commit()
+            self._remember(key, price)
+
+            self._writes += 1
+            if self._writes % PriceCache.EVICT_EVERY == 0:
+                self._evict()
+
+    def get_candles(self, currency, start, granularity):
+        """
+        Candles of the page starting at start, read from disk only: a page is loaded once per currency and run
+        :return: [time, low, high] rows, None if the page isn't cached
+        """
+        key = PriceCache.page_key(currency, start, granularity)
+
+        with self._lock:
+            row = self.db.execute('SELECT candles FROM candles WHERE currency=? AND start=? AND granularity=?',
+                                  key).fetchone()
+            if row is None:
+                self.page_misses += 1
+                metrics.count('candle_cache_misses')
+                return None
+
+            self.page_hits += 1
+            metrics.count('candle_cache_hits')
+            self._touch('candles', key)
+            return json.loads(row[0])
+
+    def put_candles(self, currency, start, granularity, candles):
+        """
+        :param candles: [time, low, high, ...] rows of the page, only the first three columns are stored
+        """
+        key = PriceCache.page_key(currency, start, granularity)
+
+        with self._lock:
+            self._clock += 1
+            self._write_touched()
+            self.db.execute('INSERT OR REPLACE INTO candles VALUES (?, ?, ?, ?, ?)',
+                            key + (json.dumps([list(c[:3]) for c in candles]), self._clock))
+            self.db.commit()
+
+            self._writes += 1
+            if self._writes % PriceCache.EVICT_EVERY == 0:
+                self._evict()
+
+    def warm(self, currency=None, start=None, end=None):
+        """
+        Pre-loads prices from disk into the memory tier, most recently used first
+        :param currency: only this currency, all if None
+        :param start: only prices at or after this date
+        :param end: only prices at or before this date
+        :return: number of loaded prices
+        """
+        query = 'SELECT currency, minute, window, price FROM prices WHERE 1=1'
+        args = []
+        if currency:
+            query += ' AND currency=?'
+            args.append(currency)
+        if start is not None:
+            query += ' AND minute>=?'
+            args.append(int(start.timestamp() // 60))
+        if end is not None:
+            query += ' AND minute<=?'
+            args.append(int(end.timestamp() // 60))
+        query += ' ORDER BY used DESC LIMIT ?'
+        args.append(self.memory_size)
+
+        with self._lock:
+            rows = self.db.execute(query, args).fetchall()
+            for cur, minute, window, price in reversed(rows):
+                self._remember((cur, minute, window), price)
+
+        return len(rows)
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'page_hits': self.page_hits,
+                'page_misses': self.page_misses,
+                'memory_size': len(self.memory)}
+
+    def close(self):
+        with self._lock:
+            self._write_touched()
+            self.db.commit()
+            self.db.close()
+
+    def _remember(self, key, price):
+        self.memory[key] = price
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _touch(self, table, key):
+        self._clock += 1
+        self._touched[(table,) + key] = self._clock
+
+    def _write_touched(self):
+        for table, where in (('prices', 'currency=? AND minute=? AND window=?'),
+                             ('candles', 'currency=? AND start=? AND granularity=?')):
+            touched = [(used,) + key[1:] for key, used in self._touched.items() if key[0] == table]
+            if touched:
+                self.db.executemany('UPDATE {t} SET used=? WHERE {w}'.format(t=table, w=where), touched)
+        self._touched.clear()
+
+    def _evict(self):
+        for table, limit in (('prices', self.max_rows), ('candles', self.max_pages)):
+            count = self.db.execute('SELECT COUNT(*) FROM {t}'.format(t=table)).fetchone()[0]
+            if count > limit:
+                self.db.execute('DELETE FROM {t} WHERE rowid IN '
+                                '(SELECT rowid FROM {t} ORDER BY used LIMIT ?)'.format(t=table), (count - limit,))
+                self.db.commit()
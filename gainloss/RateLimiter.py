@@ -0,0 +1,143 @@
+import multiprocessing
+import time
+from functools import wraps
+
+from Metrics import metrics
+
+THROTTLE_STATUSES = (429, 503)
+
+
+class TokenBucket:
+    """
+    Token bucket shared by threads and, through its shared memory state, by worker processes.
+    The rate halves on every throttled response and then grows back to max_rate with successful calls.
+    """
+
+    RATE, TOKENS, UPDATED, BLOCKED_UNTIL = range(4)
+
+    def __init__(self, max_rate, burst=1, min_rate=0.2, recovery=0.1):
+        """
+
+        :param max_rate: tokens per second
+        :param burst: max number of tokens which can be spent at once
+        :param min_rate: the rate never backs off below it
+        :param recovery: part of max_rate regained after every successful call
+        """
+        self.max_rate = max_rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self._lock = multiprocessing.Lock()
+        self._state = multiprocessing.RawArray('d', [max_rate, burst, time.monotonic(), 0])
+
+    def acquire(self):
+        """
+        Takes a token, sleeping outside of the lock until it is available
+        """
+        with self._lock:
+            state = self._state
+            now = time.monotonic()
+            rate = state[TokenBucket.RATE]
+
+            tokens = min(self.burst, state[TokenBucket.TOKENS] + (now - state[TokenBucket.UPDATED]) * rate) - 1
+            state[TokenBucket.TOKENS] = tokens
+            state[TokenBucket.UPDATED] = now
+
+            # a negative balance is a reservation of a future token
+            wait = max(-tokens / rate, state[TokenBucket.BLOCKED_UNTIL] - now, 0)
+
+        if wait > 0:
+            metrics.count('rate_limit_wait_seconds', wait)
+            time.sleep(wait)
+
+    def throttled(self, retry_after=None):
+        with self._lock:
+            state = self._state
+            rate = max(self.min_rate, state[TokenBucket.RATE] / 2)
+            state[TokenBucket.RATE] = rate
+            state[TokenBucket.TOKENS] = min(state[TokenBucket.TOKENS], 0)
+            state[TokenBucket.BLOCKED_UNTIL] = time.monotonic() + (retry_after or 1 / rate)
+
+        metrics.count('throttled_responses')
+
+    def succeeded(self):
+        with self._lock:
+            state = self._state
+            if state[TokenBucket.RATE] < self.max_rate:
+                state[TokenBucket.RATE] = min(self.max_rate, state[TokenBucket.RATE] + self.recovery * self.max_rate)
+
+    def rate(self):
+        return self._state[TokenBucket.RATE]
+
+
+# GDAX limits by endpoint group, requests per second and burst
+BUCKETS = {
+    'public': TokenBucket(3, burst=6),
+    'private': TokenBucket(5, burst=10),
+}
+
+
+def install(buckets):
+    """
+    Makes a worker process use the buckets of its parent, pass it as ProcessPoolExecutor initializer.
+    A None bucket turns the limit of its group off, e.g. for replayed responses
+    """
+    BUCKETS.update(buckets)
+
+
+def is_throttled(result):
+    if isinstance(result, dict):
+        return 'rate limit' in str(result.get('message', '')).lower()
+
+    return getattr(result, 'status_code', None) in THROTTLE_STATUSES
+
+
+def retry_after(response):
+    try:
+        return float(response.headers['Retry-After'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def rate_limited(group, retries=5):
+    """
+    Runs the decorated GDAX call through the token bucket of the endpoint group, calls answered
+    with 429/503 or a rate limit message are retried after the bucket backs off
+    """
+
+    def decorate(func):
+
+        @wraps(func)
+        def rate_limited_function(*args, **kwargs):
+            if BUCKETS[group] is None:
+                metrics.count('api_calls')
+                return func(*args, **kwargs)
+
+            for attempt in range(retries + 1):
+                bucket = BUCKETS[group]
+                bucket.acquire()
+                metrics.count('api_calls')
+
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    response = getattr(e, 'response', None)
+                    if not is_throttled(response):
+                        raise
+
+                    bucket.throttled(retry_after(response))
+                    if attempt == retries:
+                        raise
+                    continue
+
+                if not is_throttled(result):
+                    bucket.succeeded()
+                    return result
+
+                bucket.throttled()
+                if attempt == retries:
+                    return result
+
+        return rate_limited_function
+
+    return decorate
@@ -1,64 +1,53 @@
-import io
 import time
-from functools import wraps
-import requests
 import datetime
-import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import yaml
-import gdax
 import pandas as pd
 import numpy as np
 
-def rate_limited(max_per_second: int):
-    """Rate-limits the decorated function locally, for one process."""
-    lock = threading.Lock()
-    min_interval = 1.0 / max_per_second
+from PriceCache import PriceCache
+from Metrics import metrics
+from RateLimiter import rate_limited
+from Transport import GdaxTransport
+from Tran import round_to
 
-    def decorate(func):
-        last_time_called = time.perf_counter()
-
-        @wraps(func)
-        def rate_limited_function(*args, **kwargs):
-            lock.acquire()
-            nonlocal last_time_called
-            try:
-                elapsed = time.perf_counter() - last_time_called
-                left_to_wait = min_interval - elapsed
-                if left_to_wait > 0:
-                    time.sleep(left_to_wait)
-
-                return func(*args, **kwargs)
-            finally:
-                last_time_called = time.perf_counter()
-                lock.release()
-
-        return rate_limited_function
-
-    return decorate
 
 class ReportLoader:
 
     STANDARD_DELAY = 0.5
+    MAX_POLL_DELAY = 30
+    MAX_WORKERS = 4
+    CANDLE_GRANULARITY = 60
+    CANDLES_PER_PAGE = 300
 
-    def __init__(self, passphrase, key, b64secret):
-        self.gdax = gdax.AuthenticatedClient(key=key, b64secret=b64secret, passphrase=passphrase)
-        self.gdax_public = gdax.PublicClient()
+    def __init__(self, passphrase=None, key=None, b64secret=None, price_cache=None, transport=None):
+        """
+
+        :param transport: GDAX itself if None, e.g. a ReplayTransport serves recorded responses instead
+        """
+        self.transport = transport or GdaxTransport(passphrase, key, b64secret)
+        self.price_cache = price_cache
         # self.products = None
 
     @classmethod
-    def from_config(cls, config_path):
+    def from_config(cls, config_path, price_cache=None):
+        import yaml
+
         with open(config_path) as f:
             config = yaml.safe_load(f)
 
+        if price_cache is None and config.get('price_cache'):
+            price_cache = PriceCache(config['price_cache'])
+
         return cls(passphrase=config['passphrase'],
                    key=config['key'],
-                   b64secret=config['b64secret'])
+                   b64secret=config['b64secret'],
+                   price_cache=price_cache)
 
     def download_reports(self, products, start_date, end_date):
         """
-
-        :param currency:
+        Creates fills reports for all products at once, then every report is polled and
+        downloaded in its own worker as soon as it is ready
         :param products:
         :param start_date:
         :param end_date:
@@ -66,53 +55,107 @@ class ReportLoader:
 
         @rtype: pd.DataFrame
         """
-        report_ids = []
-        for p in products:
+        with metrics.stage('download'), ThreadPoolExecutor(max_workers=ReportLoader.MAX_WORKERS) as pool:
+            report_ids = list(pool.map(lambda p: self.__createReport(p, start_date, end_date), products))
+            data_frames = list(pool.map(self.__downloadReport, report_ids))
 
-            result = self.gdax.create_report(
-                report_type="fills",
-                start_date=str(start_date),
-                end_date=str(end_date),
-                product_id=p,
-                report_format='csv')
-            report_ids.append(result['id'])
+        return pd.concat(data_frames, ignore_index=True)
 
-        self.__doublesleep()
+    @rate_limited('private')
+    def __createReport(self, product, start_date, end_date):
+        return self.transport.create_report(product, start_date, end_date)
 
-        report_urls = []
+    @rate_limited('private')
+    def __getReport(self, report_id):
+        return self.transport.get_report(report_id)
 
-        while len(report_ids) > 0:
+    def __downloadReport(self, report_id):
+        delay = ReportLoader.STANDARD_DELAY
 
-            for rid in report_ids:
-                res = self.gdax.get_report(rid)
+        with metrics.stage('report_polling'):
+            while True:
+                res = self.__getReport(report_id)
                 if res['status'] == 'ready':
-                    report_urls.append(res['file_url'])
-                    report_ids.remove(rid)
-                    self.__doublesleep()
-
-        data_frames = []
-        for url in report_urls:
-            print(url)
-            s = requests.get(url).content
-            data_frames.append(
-                pd.read_csv(io.StringIO(s.decode('utf-8')))
-            )
+                    break
 
-        return pd.concat(data_frames, ignore_index=True)
+                self.__sleep(delay)
+                delay = min(delay * 2, ReportLoader.MAX_POLL_DELAY)
+
+        url = res['file_url']
+        print(url)
+
+        # parse the csv straight from the response stream instead of buffering the whole body
+        with self.transport.open_report(url) as report:
+            return pd.read_csv(report, encoding='utf-8')
 
-    @rate_limited(1.5)
     def getHistoricalUsdVal(self, currency, date, timedelta=15):
+        if self.price_cache is None:
+            return self.__fetchHistoricalUsdVal(currency, date, timedelta)
+
+        price = self.price_cache.get(currency, date, timedelta)
+        if price is None:
+            price = self.__fetchHistoricalUsdVal(currency, date, timedelta)
+            if not np.isnan(price):
+                self.price_cache.put(currency, date, timedelta, price)
+
+        return price
+
+    @rate_limited('public')
+    def __fetchHistoricalUsdVal(self, currency, date, timedelta=15):
         #https://min-api.cryptocompare.com/data/pricehistorical?fsym=ETH&tsyms=BTC,USD,EUR&ts=1518723173&e=Coinbase
         start_date = date - datetime.timedelta(seconds=timedelta)
         end_date = date + datetime.timedelta(seconds=timedelta)
 
-        result = self.gdax_public.get_product_historic_rates(
-            '{unit}-USD'.format(unit=currency),
-            start=start_date,
-            end=end_date,
-            granularity=60)
+        result = self.transport.historic_rates('{unit}-USD'.format(unit=currency), start_date, end_date, 60)
+
+        return float(round_to(np.mean([(row[1]+row[2])/2 for row in result]), 2))
+
+    def getHistoricalCandles(self, currency, dates, timedelta=15):
+        """
+        Loads 1-minute candles for every page of CANDLES_PER_PAGE minutes touched by the
+        [date - timedelta, date + timedelta] windows, one request per page not in the price cache
+        :param currency:
+        :param dates: epoch seconds
+        :param timedelta:
+        :return: candles sorted by time, columns 'time' (epoch seconds), 'low', 'high'
+
+        @rtype: pd.DataFrame
+        """
+        granularity = ReportLoader.CANDLE_GRANULARITY
+        page = ReportLoader.CANDLES_PER_PAGE * granularity
+        dates = np.asarray(dates, dtype=np.int64)
+
+        pages = np.unique(np.concatenate([(dates - timedelta - granularity) // page, (dates + timedelta) // page]))
+
+        candles = []
+        for p in pages:
+            start = datetime.datetime.fromtimestamp(int(p) * page, datetime.timezone.utc)
+            end = start + datetime.timedelta(seconds=page - granularity)
+            candles.extend(self.__candlePage(currency, start, end))
+
+        candles = pd.DataFrame([row[:3] for row in candles], columns=['time', 'low', 'high'])
+        return candles.drop_duplicates(subset='time').sort_values(by='time').reset_index(drop=True)
+
+    def __candlePage(self, currency, start, end):
+        granularity = ReportLoader.CANDLE_GRANULARITY
+        if self.price_cache is None:
+            return self.__fetchCandles(currency, start, end)
+
+        candles = self.price_cache.get_candles(currency, start, granularity)
+        if candles is None:
+            candles = self.__fetchCandles(currency, start, end)
+            # pages still filling up and failed requests, which come back empty, are asked for again next time
+            if candles and end + datetime.timedelta(seconds=granularity) < datetime.datetime.now(datetime.timezone.utc):
+                self.price_cache.put_candles(currency, start, granularity, candles)
+
+        return candles
+
+    @rate_limited('public')
+    def __fetchCandles(self, currency, start, end):
+        result = self.transport.historic_rates('{unit}-USD'.format(unit=currency), start.isoformat(), end.isoformat(),
+                                               ReportLoader.CANDLE_GRANULARITY)
 
-        return round(np.mean([(row[1]+row[2])/2 for row in result]), 2)
+        return result if isinstance(result, list) else []
 
 
     def __sleep(self, t=STANDARD_DELAY):
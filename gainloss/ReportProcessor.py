@@ -1,13 +1,15 @@
-import io
-import os
+import csv
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import numpy as np
-from Tran import Tran, TranUnit, GDAX_CLMN
+from Tran import TranTable, GDAX_CLMN, round_to
+from LotEngine import LotEngine
+from MatchLedger import MatchLedger
+from GainIndex import GainIndex
+from PositionSnapshots import PositionSnapshots
+from Metrics import metrics
 import logging
-import datetime
-
-logging.basicConfig(level=logging.INFO)
 
 class ReportProcessor:
     CLM_Timestamp = 'Timestamp'
@@ -19,116 +21,146 @@ class ReportProcessor:
     CLM_GainLoss = 'Gain'
     CLM_Currency = 'Currency'
 
+    CB_TRX_DTYPES = {CLM_Timestamp: str, CLM_Amount: float, CLM_Currency: str, CLM_TransferTotal: float,
+                     CLM_TransferFee: float, CLM_CoinbaseID: str, CLM_BitcoinHash: str}
+    CB_TAX_DTYPES = {'Received Transaction ID': str, 'Received Description': str,
+                     'Received Price Per Coin (USD)': float, 'Sent Transaction ID': str, 'Sent Description': str,
+                     'Sent Total (USD)': float}
+
+    COMPARISON_COLUMNS = ['Currency', 'Method', 'Proceeds', 'Cost', 'Short Term Gain', 'Long Term Gain',
+                          'Gain or Loss']
+
     def __init__(self, report_loader=None):
         self.rl = report_loader
 
 
     def convert_cb_to_gdax(self, cb_tran, cb_buys_sells, external_transfer_as_sell=True):
-        clean_tran_csv = self.get_csv_lines(cb_tran, 4)
-        clmns = clean_tran_csv[0].split(',')
-        clmns[-1] = ReportProcessor.CLM_BitcoinHash
-        clmns[-2] = ReportProcessor.CLM_CoinbaseID
-        clean_tran_csv[0] = ','.join(clmns)
-
-        trxs = pd.read_csv(io.StringIO(os.linesep.join(clean_tran_csv)))
-
-        clean_buys_sells = self.get_csv_lines(cb_buys_sells, starts_with='BUYS')
-        buys_sells = pd.read_csv(io.StringIO(os.linesep.join(clean_buys_sells)))
-
-        gdax_df = pd.DataFrame(columns=GDAX_CLMN.LST_Original)
-
-        for index, row in trxs.iterrows():
-            buy_tran = row[ReportProcessor.CLM_Amount] > 0
-
-            if np.isnan(row[ReportProcessor.CLM_TransferTotal]):  # incoming or outcoming tran
-
-                trx_id = row[ReportProcessor.CLM_CoinbaseID]
-
-                # check approx cost of incoming currency from external wallet
-                tran_row = buys_sells.loc[buys_sells['Received Transaction ID' if buy_tran else 'Sent Transaction ID'] == trx_id].iloc[0]
-
-                if buy_tran:
-                    if tran_row['Received Description'].lower() == 'received from gdax': # skipping transfers
-                        continue
-
-                    if isinstance(row[ReportProcessor.CLM_BitcoinHash], str) and row[ReportProcessor.CLM_BitcoinHash]:
-                        price_per_coin = tran_row[
-                            'Received Price Per Coin (USD)']
-                        row[ReportProcessor.CLM_TransferTotal] = \
-                            round(price_per_coin * trxs.loc[index, ReportProcessor.CLM_Amount], 8)
-                        row[ReportProcessor.CLM_TransferFee] = 0
-
-                else:  # if sell tran
-                    if tran_row['Sent Description'].lower() == 'sent to gdax':
-                        continue
-                    if not external_transfer_as_sell:   # consider that we still have crypto which was sent to ext addr
-                        continue
-                    else:                               # consider we sold crypto sent to ext addr
-                        row[ReportProcessor.CLM_TransferTotal] = tran_row['Sent Total (USD)']
-                        row[ReportProcessor.CLM_TransferFee] = 0
-
-            total = row[ReportProcessor.CLM_TransferTotal] - row[ReportProcessor.CLM_TransferFee]
-            price = round(total / row[ReportProcessor.CLM_Amount], 2)
-
-            row_val = [[
-                row[ReportProcessor.CLM_CoinbaseID],  # -> trade id
-                row[ReportProcessor.CLM_Currency] + '-USD',  # -> Product,
-                'BUY' if buy_tran else 'SELL',  # -> Side,
-                row[ReportProcessor.CLM_Timestamp],  # -> CreatedAt,
-                abs(row[ReportProcessor.CLM_Amount]),  # -> Size,
-                row[ReportProcessor.CLM_Currency],  # -> SizeUnit,
-                abs(price),  # -> Price,
-                row[ReportProcessor.CLM_TransferFee],  # -> Fee,
-                abs(total) if buy_tran else -abs(total),  # -> Total,
-                'USD'  # -> TradeUnit,
-            ]]
-            gdax_row = pd.DataFrame(data=row_val, columns=GDAX_CLMN.LST_Original)
-            gdax_df = gdax_df.append(gdax_row, ignore_index=True)
-
-
-        return gdax_df
-
-    def get_csv_lines(self, file, skip=0, starts_with=None):
-        with open(file, 'r') as csv_file:
-            if not starts_with:
-                return csv_file.readlines()[skip:]
-            else:
-                lines = csv_file.readlines()
-                for i in range(0, len(lines)):
-                    if lines[i].startswith(starts_with):
-                        return lines[i+1:]
+        # the last two columns of the transactions export are the coinbase id and the bitcoin hash
+        trxs = self.read_csv_section(cb_tran, 4, rename_last=[ReportProcessor.CLM_CoinbaseID,
+                                                              ReportProcessor.CLM_BitcoinHash],
+                                     dtype=ReportProcessor.CB_TRX_DTYPES)
+        buys_sells = self.read_csv_section(cb_buys_sells, starts_with='BUYS', dtype=ReportProcessor.CB_TAX_DTYPES)
+
+        amount = trxs[ReportProcessor.CLM_Amount]
+        trx_ids = trxs[ReportProcessor.CLM_CoinbaseID]
+        total = trxs[ReportProcessor.CLM_TransferTotal].astype(float)
+        fee = trxs[ReportProcessor.CLM_TransferFee].astype(float)
+
+        buy_tran = amount > 0
+        transfer = total.isnull()  # incoming or outcoming tran
+        incoming = transfer & buy_tran
+        outgoing = transfer & ~buy_tran
+
+        # check approx cost of incoming currency from external wallet
+        received = self.index_by(buys_sells, 'Received Transaction ID')
+        sent = self.index_by(buys_sells, 'Sent Transaction ID')
+
+        skip = (incoming & (trx_ids.map(received['Received Description']).str.lower() == 'received from gdax')) | \
+               (outgoing & (trx_ids.map(sent['Sent Description']).str.lower() == 'sent to gdax'))  # skipping transfers
+
+        if not external_transfer_as_sell:  # consider that we still have crypto which was sent to ext addr
+            skip |= outgoing
+
+        hashed = trxs[ReportProcessor.CLM_BitcoinHash].apply(lambda h: isinstance(h, str) and len(h) > 0).astype(bool)
+        external_in = incoming & hashed & ~skip
+        external_out = outgoing & ~skip  # consider we sold crypto sent to ext addr
+
+        price_per_coin = trx_ids.map(received['Received Price Per Coin (USD)']).astype(float)
+        total[external_in] = (price_per_coin * amount)[external_in].round(8)
+        total[external_out] = trx_ids.map(sent['Sent Total (USD)']).astype(float)[external_out]
+        fee[external_in | external_out] = 0
+
+        keep = ~skip
+        buy_tran = buy_tran[keep]
+        amount = amount[keep]
+        fee = fee[keep]
+        total = (total - fee)[keep]
+
+        return pd.DataFrame({
+            GDAX_CLMN.TradeId: trx_ids[keep],
+            GDAX_CLMN.Product: trxs.loc[keep, ReportProcessor.CLM_Currency] + '-USD',
+            GDAX_CLMN.Side: np.where(buy_tran, 'BUY', 'SELL'),
+            GDAX_CLMN.CreatedAt: trxs.loc[keep, ReportProcessor.CLM_Timestamp],
+            GDAX_CLMN.Size: amount.abs(),
+            GDAX_CLMN.SizeUnit: trxs.loc[keep, ReportProcessor.CLM_Currency],
+            GDAX_CLMN.Price: (total / amount).round(2).abs(),
+            GDAX_CLMN.Fee: fee,
+            GDAX_CLMN.Total: np.where(buy_tran, total.abs(), -total.abs()),
+            GDAX_CLMN.TradeUnit: 'USD'
+        }, columns=GDAX_CLMN.LST_Original).reset_index(drop=True)
+
+    @staticmethod
+    def index_by(df, clmn):
+        return df.dropna(subset=[clmn]).drop_duplicates(subset=clmn, keep='first').set_index(clmn)
+
+    def convert_cb_reports(self, files, external_transfer_as_sell=True, workers=4):
+        """
+        convert_cb_to_gdax of several currencies at once, e.g. of multi-year exports
+        :param files: (transactions csv, tax csv) pairs by currency
+        :type files: dict
+        :return: converted reports by currency
+        :rtype: dict
+        """
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            converted = {cur: pool.submit(self.convert_cb_to_gdax, cb_tran, cb_buys_sells, external_transfer_as_sell)
+                         for cur, (cb_tran, cb_buys_sells) in files.items()}
+
+        return {cur: f.result() for cur, f in converted.items()}
+
+    def read_csv_section(self, file, skip=0, starts_with=None, rename_last=None, dtype=None):
+        """
+        Reads the csv table of an export which starts after skip lines, or right after the line starting
+        with starts_with. The preamble is skipped line by line and read_csv parses the rest straight from the file
+
+        :param rename_last: names replacing the last header columns
+        :param dtype: column types, the ones missing are inferred
+        :rtype: pd.DataFrame
+        """
+        with open(file, 'r', newline='') as csv_file:
+            for i in range(skip):
+                csv_file.readline()
+
+            if starts_with:
+                line = csv_file.readline()
+                while line and not line.startswith(starts_with):
+                    line = csv_file.readline()
+
+                if not line:
+                    raise ValueError('{f} has no {s} section'.format(f=file, s=starts_with))
+
+            header = next(csv.reader([csv_file.readline()]), [])
+            if rename_last:
+                header[-len(rename_last):] = rename_last
+
+            return pd.read_csv(csv_file, header=None, names=header, dtype=dtype)
 
     def merge_reports(self, reports, end_date=None):
         rpt = pd.concat(reports, ignore_index=True)
-        rpt[GDAX_CLMN.CreatedAt] = pd.to_datetime(rpt[GDAX_CLMN.CreatedAt])
+        # enriched products come with parsed dates, coinbase reports with strings, all of them are UTC
+        rpt[GDAX_CLMN.CreatedAt] = pd.to_datetime(rpt[GDAX_CLMN.CreatedAt], utc=True, format='ISO8601')
         return rpt[rpt[GDAX_CLMN.CreatedAt] <= end_date] if end_date else rpt
 
+    @metrics.timed('tax_conversion')
     def convert_to_tax_transactions(self, rpt, curr):
-        return pd.DataFrame([Tran(row).convert_to_tax_tran(curr) for index, row in rpt.iterrows()])
-
-    def create_tax_gainloss_row(self, description, date_aquired, date_sold, sales_price, cost):
-        tfmt = '%m/%d/%Y'
-        return {
-            'Description': description,
-            'Date Aquired': date_aquired.strftime(tfmt) if isinstance(date_aquired, datetime.date) else date_aquired,
-            'Date Sold': date_sold.strftime(tfmt) if isinstance(date_sold, datetime.date) else date_sold,
-            'Proceeds': round(sales_price, 2),
-            'Cost': round(cost, 2),
-            'Gain or Loss': round(sales_price - cost, 2),
-            'Tran DT': date_sold
-        }
-
+        metrics.count('rows_tax_converted', len(rpt))
+        return TranTable(rpt).convert_to_tax_tran(curr)
 
-    def enrich_gdax_rpt(self, rpt):
+    @metrics.timed('enrichment')
+    def enrich_gdax_rpt(self, rpt, batched=False):
         """
 
         :param rpt:
+        :param batched: prefetch candles per currency in pages and join them to all rows at once
         :return:
 
         @rtype: pd.DataFrame
         """
-        rpt[GDAX_CLMN.CreatedAt] = pd.to_datetime(rpt[GDAX_CLMN.CreatedAt])
-        rpt = rpt.sort_values(by=GDAX_CLMN.CreatedAt)
+        rpt[GDAX_CLMN.CreatedAt] = pd.to_datetime(rpt[GDAX_CLMN.CreatedAt], format='ISO8601')
+        rpt = rpt.sort_values(by=GDAX_CLMN.CreatedAt, kind='stable')
+        metrics.count('rows_enriched', len(rpt))
+
+        if batched:
+            return self.enrich_gdax_rpt_batched(rpt)
 
         for index, row in rpt.iterrows():
             if row[GDAX_CLMN.TradeUnit] == 'USD':
@@ -144,7 +176,70 @@ class ReportProcessor:
 
         return rpt
 
-    def get_profit_loss(self, rpt, currency, start, end, fifo=True, tax_gainloss=True):
+    def enrich_gdax_rpt_batched(self, rpt, timedelta=15):
+        crypto = rpt[GDAX_CLMN.TradeUnit] != 'USD'
+        if not crypto.any():
+            return rpt
+
+        created_at = rpt[GDAX_CLMN.CreatedAt]
+        secs = ((created_at - pd.Timestamp(0, tz=created_at.dt.tz)) // pd.Timedelta(seconds=1)).values
+
+        sides = [(GDAX_CLMN.ADV_TradeUnitPrice, GDAX_CLMN.TradeUnit),
+                 (GDAX_CLMN.ADV_OriginalUnitPrice, GDAX_CLMN.SizeUnit)]
+
+        for price_clmn, unit_clmn in sides:
+            if price_clmn not in rpt:
+                rpt[price_clmn] = np.nan
+
+        currencies = pd.unique(pd.concat([rpt.loc[crypto, unit_clmn] for price_clmn, unit_clmn in sides]))
+
+        for cur in currencies:
+            masks = [(crypto & (rpt[unit_clmn] == cur)).values for price_clmn, unit_clmn in sides]
+
+            candles = self.rl.getHistoricalCandles(cur, secs[np.logical_or(*masks)], timedelta)
+
+            for (price_clmn, unit_clmn), mask in zip(sides, masks):
+                rpt.loc[mask, price_clmn] = self.candle_prices(candles, secs[mask], timedelta)
+
+        return rpt
+
+    @staticmethod
+    def candle_prices(candles, secs, timedelta=15, granularity=60):
+        """
+        Mean of (low + high) / 2 over the candles overlapping [t - timedelta, t + timedelta]
+        for every t in secs, the nearest candle is used when none overlaps
+        :param candles: sorted by time
+        :param secs: epoch seconds
+        :return: prices rounded to cents
+        """
+        if len(candles) == 0:
+            return np.full(len(secs), np.nan)
+
+        times = candles['time'].values
+        mids = ((candles['low'] + candles['high']) / 2).values
+
+        lo = np.searchsorted(times, secs - timedelta - granularity, side='right')
+        hi = np.searchsorted(times, secs + timedelta, side='right')
+        count = hi - lo
+
+        # a window holds a few candles, they are added one by one as np.mean does: differences of prefix sums
+        # are off by some ulps and mids are often at half a cent, where that changes the rounded price
+        sums = np.zeros(len(secs))
+        for k in range(int(count.max(initial=0))):
+            sums += np.where(k < count, mids[np.minimum(lo + k, len(mids) - 1)], 0)
+
+        right = np.clip(np.searchsorted(times, secs), 0, len(times) - 1)
+        left = np.clip(right - 1, 0, len(times) - 1)
+        nearest = np.where(np.abs(times[left] - secs) <= np.abs(times[right] - secs), left, right)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            prices = np.where(count > 0, sums / count, mids[nearest])
+
+        return round_to(prices, 2)
+
+    @metrics.timed('lot_matching')
+    def get_profit_loss(self, rpt, currency, start, end, method=LotEngine.FIFO, tax_gainloss=True, lots=None,
+                        info=True):
         """
 
         :param rpt:
@@ -152,125 +247,201 @@ class ReportProcessor:
         :param currency:
         :param start:
         :param end:
-        :param fifo:
+        :param method: lot selection method: fifo, lifo, hifo or lofo, ignored if lots are given
+        :param lots: engine to match with, e.g. restored from a checkpoint. It holds the open lots at the end
+        :type lots: LotEngine
+        :param info: fill the info column with the lot slices of every sell
         :return:
         :rtype: pd.DataFrame
         """
 
         rpt = rpt.copy()
 
-        rpt[GDAX_CLMN.CreatedAt] = pd.to_datetime(rpt[GDAX_CLMN.CreatedAt])
+        rpt[GDAX_CLMN.CreatedAt] = pd.to_datetime(rpt[GDAX_CLMN.CreatedAt], format='ISO8601')
         rpt[GDAX_CLMN.ADV_GainLoss] = np.nan
         rpt['info'] = ''
 
         # use only dataset within date range (end date). We'll need to process from the very beginning
         rpt = rpt[(rpt[GDAX_CLMN.CreatedAt] <= end)]
 
-        transactions = []
-        for index, row in rpt.iterrows():
-            t = Tran(row)
-            t.convert_fee_to_base(currency)
-            transactions.append((t, index))
+        if lots is None:
+            lots = LotEngine(method)
+        elif lots.as_of is not None:  # everything up to the checkpoint is already in the lots
+            rpt = rpt[rpt[GDAX_CLMN.CreatedAt] > lots.as_of]
 
-        buys = []
-        gain_loss_tax_list = [] if tax_gainloss else None
+        consumed = lots.consumed
+        ledger = self.__match_lots(TranTable(rpt).convert_fee_to_base(currency), currency, lots)
 
-        for t, row_ix in transactions:
-            if t.sell_currency() != currency:
-                buys.append(t)
-                continue
+        rpt[GDAX_CLMN.ADV_GainLoss] = ReportProcessor.by_row(len(rpt), ledger.sell_rows, ledger.gains(), np.nan)
+        if info:
+            rpt['info'] = ReportProcessor.by_row(len(rpt), ledger.sell_rows, ledger.info(), '')
 
-            sell_amount = t.sell.vol  # always positive
+        metrics.count('rows_matched', len(rpt))
+        metrics.count('lots_consumed', lots.consumed - consumed)
 
-            logging.info('Remaining balance: %s', round(sum([t.buy.vol for t in buys]), 8))
-            logging.info('Selling vol: %s', sell_amount)
+        return (rpt[(rpt[GDAX_CLMN.CreatedAt] >= start) & (rpt[GDAX_CLMN.CreatedAt] <= end) & ~np.isnan(rpt[GDAX_CLMN.ADV_GainLoss])],
+                ledger.tax_rows(currency) if tax_gainloss else None)
 
-            info = ''
-            buy_cost = 0
-            buy_fee = 0
+    @staticmethod
+    def by_row(length, rows, values, fill):
+        column = np.full(length, fill, dtype=object if isinstance(fill, str) else float)
+        column[np.frombuffer(rows, dtype=np.int64)] = values
+        return column
 
-            for prev_buy in (buys[:] if fifo else buys[::-1]):
+    @metrics.timed('method_comparison')
+    def compare_methods(self, rpt, currency, start, end, methods=None):
+        """
+        Gains of the sells between start and end under several lot selection methods. The report is parsed
+        and its fees converted once, every method matches fresh lots built from the same transaction table.
 
-                # make sure we got 'buy' transaction for this currency and it still has volumes left
-                if prev_buy.buy_currency() != currency or prev_buy.buy.vol <= 0:
-                    continue
+        :param rpt:
+        :type rpt: pd.DataFrame
+        :param currency:
+        :param start:
+        :param end:
+        :param methods: lot selection methods, all LotEngine.METHODS if None
+        :return: proceeds, cost, short and long term gain, a row per method
+        :rtype: pd.DataFrame
+        """
+        rpt = rpt.copy()
+        rpt[GDAX_CLMN.CreatedAt] = pd.to_datetime(rpt[GDAX_CLMN.CreatedAt], format='ISO8601')
+        rpt = rpt[(rpt[GDAX_CLMN.CreatedAt] <= end)]
 
-                if sell_amount - prev_buy.buy.vol >= 0:
-                    sell_amount = round(sell_amount - prev_buy.buy.vol, 8)
+        table = TranTable(rpt).convert_fee_to_base(currency)
+        comparison = []
 
-                    if gain_loss_tax_list is not None:
-                        self.add_tax_gainloss_row(gain_loss_tax_list, currency, prev_buy, t, prev_buy.buy.vol)
+        for method in methods or LotEngine.METHODS:
+            ledger = self.__match_lots(table, currency, LotEngine(method))
+            comparison.append(dict(self.summarize_gains(ledger.tax_rows(currency), start, end),
+                                   Currency=currency, Method=method))
 
-                    buy_cost += prev_buy.buy.usd_total_price
-                    buy_fee += prev_buy.tran_usd_fee()
+        return pd.DataFrame(comparison, columns=ReportProcessor.COMPARISON_COLUMNS)
 
-                    info += '{a}@{p}/{t},fee:{f};'.format(
-                        a=prev_buy.buy.vol,
-                        p=prev_buy.buy.usd_unit_price,
-                        t=prev_buy.buy.usd_total_price,
-                        f=prev_buy.tran_usd_fee())
+    @metrics.timed('gain_indexing')
+    def index_gains(self, reports, end=None, methods=None):
+        """
+        Matches the whole history of every currency once and indexes the tax gain/loss rows by sale date,
+        so the totals and rows of any date range, e.g. quarters or a fiscal year, are queried without matching again
+
+        :param reports: reports by currency
+        :type reports: dict
+        :param end: only fills up to it are matched, all if None
+        :param methods: lot selection method by currency, fifo if missing
+        :type methods: dict
+        :rtype: GainIndex
+        """
+        tax_rows = {}
 
-                    prev_buy.buy.vol = 0
-                    prev_buy.buy.usd_total_price = 0
+        for currency, rpt in reports.items():
+            rpt = rpt.copy()
+            rpt[GDAX_CLMN.CreatedAt] = pd.to_datetime(rpt[GDAX_CLMN.CreatedAt], format='ISO8601')
+            if end is not None:
+                rpt = rpt[(rpt[GDAX_CLMN.CreatedAt] <= end)]
 
-                    buys.remove(prev_buy)
+            method = (methods or {}).get(currency, LotEngine.FIFO)
+            ledger = self.__match_lots(TranTable(rpt).convert_fee_to_base(currency), currency, LotEngine(method))
+            tax_rows[currency] = ledger.tax_rows(currency)
 
-                    if sell_amount == 0:
-                        break
-                else:
-                    prise_per_coin = prev_buy.buy.usd_unit_price
+        return GainIndex(tax_rows)
 
-                    total_for_partial_tran = round(sell_amount * prise_per_coin, 8)
+    @metrics.timed('position_snapshots')
+    def snapshot_positions(self, reports, dates, methods=None, timedelta=15, lots=None):
+        """
+        Open positions and unrealized gains of every currency at each of the dates, e.g. month ends.
+        The lots of a currency are matched once over its history and the open ones recorded at every date
+        on the way, the positions are then valued with a single batched candle lookup per currency
+
+        :param reports: reports by currency
+        :type reports: dict
+        :param dates: snapshot dates, UTC if naive
+        :param methods: lot selection method by currency, fifo if missing
+        :type methods: dict
+        :param lots: engines to match with by currency, e.g. restored from checkpoints, instead of methods.
+        Only the fills after their checkpoint are matched and every date has to be later than it
+        :type lots: dict
+        :return: lots, volume, USD cost, price, value and unrealized gain by date and currency
+        :rtype: pd.DataFrame
+        """
+        positions = []
 
-                    buy_cost += total_for_partial_tran
+        for currency, rpt in reports.items():
+            rpt = rpt.copy()
+            rpt[GDAX_CLMN.CreatedAt] = pd.to_datetime(rpt[GDAX_CLMN.CreatedAt], format='ISO8601')
 
-                    partial_fee = 0
+            engine = (lots or {}).get(currency)
+            if engine is None:
+                engine = LotEngine((methods or {}).get(currency, LotEngine.FIFO))
 
-                    if gain_loss_tax_list is not None:
-                        self.add_tax_gainloss_row(gain_loss_tax_list, currency, prev_buy, t, sell_amount)
+            snapshots = PositionSnapshots(currency, dates)
+            if engine.as_of is not None:  # everything up to the checkpoint is already in the lots
+                as_of = pd.Timestamp(engine.as_of)
+                as_of = as_of.tz_localize('UTC') if as_of.tzinfo is None else as_of
+                if len(snapshots.dates) > 0 and snapshots.dates.iloc[0] < as_of:
+                    raise ValueError('{c} positions before the checkpoint of {d} are unknown'.format(
+                        c=currency, d=engine.as_of))
+                rpt = rpt[rpt[GDAX_CLMN.CreatedAt] > as_of]
 
-                    if prev_buy.tran_usd_fee() > 0:  # apply just a part of the fee
+            self.__match_lots(TranTable(rpt).convert_fee_to_base(currency), currency, engine, snapshots)
 
-                        partial_sell_ratio = sell_amount / prev_buy.buy.vol
-                        partial_fee = round(partial_sell_ratio * prev_buy.tran_usd_fee(), 8)
-                        buy_fee += partial_fee
+            prices = None
+            if self.rl is not None and len(snapshots.dates) > 0:
+                secs = ((snapshots.dates - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)).values
+                prices = self.candle_prices(self.rl.getHistoricalCandles(currency, secs, timedelta), secs, timedelta)
 
-                        partial_fee_original_units = round(partial_sell_ratio * prev_buy.fee, 8)
-                        # trxs.loc[pos_index, CLM_TransferFee] = partial_fee_original_units
-                        prev_buy.fee = round(prev_buy.fee - partial_fee_original_units, 8)
+            positions.append(snapshots.positions(prices))
 
-                    prev_buy.buy.vol = round(prev_buy.buy.vol - sell_amount, 8)
-                    prev_buy.buy.usd_total_price = round(prev_buy.buy.vol * prise_per_coin, 2)
+        if not positions:
+            return pd.DataFrame(columns=PositionSnapshots.COLUMNS)
 
-                    info += '{a}@{p}/{t},fee:{f};'.format(
-                        a=sell_amount,
-                        p=prise_per_coin,
-                        t=total_for_partial_tran,
-                        f=partial_fee)
+        return pd.concat(positions, ignore_index=True).sort_values(
+            by=[PositionSnapshots.CLM_Date], kind='stable', ignore_index=True)
 
-                    break
+    @staticmethod
+    def summarize_gains(tax, start, end):
+        """
+        Totals of the tax gain/loss rows sold between start and end, a lot held for more than a year is long term
+        """
+        if len(tax) > 0:
+            sold = pd.to_datetime(tax['Tran DT'])
+            tax = tax[(sold >= start) & (sold <= end)]
 
-            sale_fee = t.tran_usd_fee()
-            rpt.loc[row_ix, GDAX_CLMN.ADV_GainLoss] = round(t.sell.usd_total_price - buy_cost - buy_fee - sale_fee, 2)
+        long_term = GainIndex.long_term(tax)
 
-            if sale_fee > 0:
-                info += ' sale_fee:{sf}'.format(sf=sale_fee)
+        return {
+            'Proceeds': round(tax['Proceeds'].sum(), 2),
+            'Cost': round(tax['Cost'].sum(), 2),
+            'Short Term Gain': round(tax.loc[~long_term, 'Gain or Loss'].sum(), 2),
+            'Long Term Gain': round(tax.loc[long_term, 'Gain or Loss'].sum(), 2),
+            'Gain or Loss': round(tax['Gain or Loss'].sum(), 2)
+        }
 
-            rpt.loc[row_ix, 'info'] = info
+    def __match_lots(self, table, currency, lots, snapshots=None):
+        """
+        Adds bought lots and matches every sell of the currency against them
+        :type table: TranTable
+        :param snapshots: open positions to take on the way
+        :type snapshots: PositionSnapshots
+        :return: the sells and the lot slices they used
+        :rtype: MatchLedger
+        """
+        ledger = MatchLedger()
 
+        for row, t in enumerate(table.trans()):
+            if snapshots is not None:
+                snapshots.take(lots, t.created_at)
 
-        return (rpt[(rpt[GDAX_CLMN.CreatedAt] >= start) & (rpt[GDAX_CLMN.CreatedAt] <= end) & ~np.isnan(rpt[GDAX_CLMN.ADV_GainLoss])],
-                pd.DataFrame([item for item in gain_loss_tax_list if item['Proceeds'] != 0]))
+            if t.sell_currency() != currency:
+                lots.add(t)
+                continue
 
-    def add_tax_gainloss_row(self, gain_loss_tran_list, currency, buy_tran, sell_tran, sell_amount):
-        gain_loss_tran_list.append(
-            self.create_tax_gainloss_row(
-                '{vol} {cur}'.format(vol=sell_amount, cur=currency),
-                buy_tran.created_at,
-                sell_tran.created_at,
-                sell_tran.sell.getCost(sell_amount) + sell_tran.tran_usd_fee(sell_amount),
-                buy_tran.buy.getCost(sell_amount) - buy_tran.tran_usd_fee(sell_amount))
-        )
+            logging.debug('Remaining balance: %s', lots.balance(currency))
+            logging.debug('Selling vol: %s', t.sell.vol)
 
+            ledger.sell(row, t)
+            for prev_buy, vol, price, total, fee in lots.consume(currency, t.sell.units):
+                ledger.match(prev_buy, vol, price, total, fee)
 
+        if snapshots is not None:
+            snapshots.take(lots)
 
+        return ledger
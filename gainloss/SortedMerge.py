@@ -0,0 +1,90 @@
+import pandas as pd
+
+
+def frame_chunks(df, chunk_size):
+    """
+    Splits an in-memory report into chunks, so it can be merged with reports read chunk-wise from files
+    """
+    for start in range(0, max(len(df), 1), chunk_size):
+        yield df.iloc[start:start + chunk_size]
+
+
+def merge_sorted(sources, sort_key):
+    """
+    k-way merge of reports which are each already sorted by sort_key. Only the current chunk of every
+    source is held in memory: the rows before the smallest last key of the current chunks are merged
+    and yielded, the rest waits for the next round. Rows with the same key keep the order of the sources,
+    so rows equal to that key wait until every source whose chunk ends with it has been read past it.
+
+    :param sources: iterables of pd.DataFrame chunks, one per report
+    :param sort_key: column, parsed with pd.to_datetime as the concat-and-sort merge did
+    :return: generator of merged pd.DataFrame chunks
+    """
+    sources = [iter(s) for s in sources]
+    buffers = [None] * len(sources)
+    last_keys = [None] * len(sources)
+    empty = None
+    merged_any = False
+
+    def refill(i):
+        nonlocal empty
+
+        for chunk in sources[i]:
+            if empty is None:
+                empty = chunk.iloc[:0]
+            if len(chunk) == 0:
+                continue
+
+            chunk = chunk.copy()
+            chunk[sort_key] = pd.to_datetime(chunk[sort_key], format='ISO8601')
+            keys = chunk[sort_key]
+
+            if not keys.is_monotonic_increasing or (last_keys[i] is not None and keys.iloc[0] < last_keys[i]):
+                raise ValueError('report {i} is not sorted by {k}'.format(i=i, k=sort_key))
+
+            last_keys[i] = keys.iloc[-1]
+            return chunk
+
+        sources[i] = None
+        return None
+
+    for i in range(len(sources)):
+        buffers[i] = refill(i)
+
+    while any(b is not None for b in buffers):
+        # rows after the bound may still be preceded by rows of a chunk which has not been read yet
+        bounds = [b[sort_key].iloc[-1] for i, b in enumerate(buffers) if b is not None and sources[i] is not None]
+        bound = min(bounds) if bounds else None
+
+        cuts = [0 if b is None else len(b) if bound is None else b[sort_key].searchsorted(bound, side='left')
+                for b in buffers]
+
+        if sum(cuts) == 0:
+            # every row left is at the bound, the next chunks of the sources ending with it may hold more of them
+            for i, b in enumerate(buffers):
+                if sources[i] is not None and b[sort_key].iloc[-1] == bound:
+                    chunk = refill(i)
+                    if chunk is not None:
+                        buffers[i] = pd.concat([b, chunk])
+            continue
+
+        parts = []
+        for i, (b, n) in enumerate(zip(buffers, cuts)):
+            if b is None:
+                continue
+
+            if n > 0:
+                parts.append(b.iloc[:n])
+            buffers[i] = b.iloc[n:] if n < len(b) else (refill(i) if sources[i] is not None else None)
+
+        merged = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0].reset_index(drop=True)
+        if len(parts) > 1:
+            merged = merged.sort_values(by=[sort_key], kind='stable', ignore_index=True)
+
+        merged_any = True
+        yield merged
+
+    if not merged_any and empty is not None:
+        empty = empty.copy()
+        empty[sort_key] = pd.to_datetime(empty[sort_key])
+        yield empty
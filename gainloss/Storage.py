@@ -0,0 +1,228 @@
+import os
+
+import pandas as pd
+
+from Tran import GDAX_CLMN
+
+
+class CsvStorage:
+    """
+    Plain CSV files, dates have to be parsed again on every read
+    """
+
+    NAME = 'csv'
+    EXT = '.csv'
+
+    # parsed to UTC datetimes on read, as the arrow storages give them back
+    DATE_COLUMNS = [GDAX_CLMN.CreatedAt]
+    # pandas leaves out the fraction of seconds when a frame has none, appended chunks would mix formats
+    DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f%z'
+
+    def path(self, path):
+        return os.path.splitext(path)[0] + self.EXT
+
+    def exists(self, path):
+        return os.path.exists(self.path(path))
+
+    def write(self, df, path, columns=None):
+        df.to_csv(self.path(path), index=False, columns=columns, date_format=CsvStorage.DATE_FORMAT)
+
+    def read(self, path, columns=None):
+        return CsvStorage.parse_dates(pd.read_csv(self.path(path), usecols=columns))
+
+    def read_chunks(self, path, chunk_size, columns=None):
+        """
+        Reads the file as a sequence of DataFrames of at most chunk_size rows
+        """
+        with pd.read_csv(self.path(path), usecols=columns, chunksize=chunk_size) as reader:
+            for chunk in reader:
+                yield CsvStorage.parse_dates(chunk)
+
+    def columns(self, path):
+        return list(pd.read_csv(self.path(path), nrows=0).columns)
+
+    @staticmethod
+    def parse_dates(df):
+        """
+        Dates of downloaded fills end with Z, the ones written by pandas with +00:00
+        """
+        for c in CsvStorage.DATE_COLUMNS:
+            if c in df:
+                df[c] = pd.to_datetime(df[c], utc=True, format='ISO8601')
+        return df
+
+    def writer(self, path, columns=None):
+        """
+        Appends DataFrames to the file chunk by chunk, use it as a context manager
+        :param columns: columns of the file, the ones of the first written chunk if None
+        """
+        return CsvWriter(self.path(path), columns)
+
+
+class ParquetStorage(CsvStorage):
+    """
+    Typed columnar files, datetimes and categoricals survive the round trip and only
+    the requested columns are read
+    """
+
+    NAME = 'parquet'
+    EXT = '.parquet'
+
+    def __init__(self):
+        self.parquet = import_arrow().parquet
+
+    def write(self, df, path, columns=None):
+        arrow_safe(df if columns is None else df[columns]).to_parquet(self.path(path), index=False)
+
+    def read(self, path, columns=None):
+        return pd.read_parquet(self.path(path), columns=columns)
+
+    def read_chunks(self, path, chunk_size, columns=None):
+        for batch in self.parquet.ParquetFile(self.path(path)).iter_batches(chunk_size, columns=columns):
+            yield batch.to_pandas()
+
+    def columns(self, path):
+        return self.parquet.read_schema(self.path(path)).names
+
+    def writer(self, path, columns=None):
+        return ArrowWriter(self.path(path), columns, self.parquet.ParquetWriter)
+
+
+class FeatherStorage(CsvStorage):
+    """
+    Arrow IPC files, read memory-mapped
+    """
+
+    NAME = 'feather'
+    EXT = '.feather'
+
+    def __init__(self):
+        self.feather = import_arrow().feather
+
+    def write(self, df, path, columns=None):
+        arrow_safe(df if columns is None else df[columns]).reset_index(drop=True).to_feather(self.path(path))
+
+    def read(self, path, columns=None):
+        return self.feather.read_table(self.path(path), columns=columns, memory_map=True).to_pandas()
+
+    def read_chunks(self, path, chunk_size, columns=None):
+        # the table is memory mapped, only the converted chunk is held in memory
+        table = self.feather.read_table(self.path(path), columns=columns, memory_map=True)
+        for start in range(0, max(table.num_rows, 1), chunk_size):
+            yield table.slice(start, chunk_size).to_pandas()
+
+    def columns(self, path):
+        return self.feather.read_table(self.path(path), memory_map=True).column_names
+
+    def writer(self, path, columns=None):
+        # feather v2 is the Arrow IPC file format, written batch by batch
+        ipc = import_arrow().ipc
+        return ArrowWriter(self.path(path), columns,
+                           lambda p, schema: ipc.new_file(p, schema, options=ipc.IpcWriteOptions(compression='lz4')))
+
+
+class CsvWriter:
+    """
+    The file is only created by the first write, or by close when nothing but empty chunks was written
+    """
+
+    def __init__(self, path, columns=None):
+        self.path = path
+        self.columns = columns
+        self.file = None
+        self.empty = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, df):
+        """
+        Appends the rows of df, empty chunks only matter when nothing else gets written
+        """
+        if len(df) == 0:
+            self.empty = df
+            return
+
+        if self.columns is None:
+            self.columns = list(df.columns)
+
+        self._append(df.reindex(columns=self.columns))
+
+    def close(self):
+        if self.file is None and self.empty is not None:
+            self._append(self.empty.reindex(columns=self.columns if self.columns is not None else self.empty.columns))
+
+        if self.file is not None:
+            self.file.close()
+
+    def _append(self, df):
+        header = self.file is None
+        if header:
+            self.file = open(self.path, 'w', newline='')
+
+        df.to_csv(self.file, index=False, header=header, date_format=CsvStorage.DATE_FORMAT)
+
+
+class ArrowWriter(CsvWriter):
+    """
+    The schema is taken from the first written chunk, later chunks are cast to it
+    """
+
+    def __init__(self, path, columns, new_writer):
+        super().__init__(path, columns)
+        self.new_writer = new_writer
+        self.schema = None
+
+    def _append(self, df):
+        pa = import_arrow()
+        table = pa.Table.from_pandas(arrow_safe(df), preserve_index=False)
+
+        if self.file is None:
+            self.schema = table.schema
+            self.file = self.new_writer(self.path, self.schema)
+        else:
+            table = table.cast(self.schema)
+
+        self.file.write_table(table)
+
+
+STORAGES = {
+    'csv': CsvStorage,
+    'parquet': ParquetStorage,
+    'feather': FeatherStorage
+}
+
+
+def get_storage(name):
+    return STORAGES[name]()
+
+
+def arrow_safe(df):
+    """
+    Arrow columns have a single type: object columns mixing e.g. GDAX integer and Coinbase string trade ids
+    are stored as strings, the same values a CSV round trip gives back
+    """
+    mixed = [c for c in df.columns if df[c].dtype == object and
+             pd.api.types.infer_dtype(df[c], skipna=True) in ('mixed', 'mixed-integer')]
+    if not mixed:
+        return df
+
+    df = df.copy()
+    for c in mixed:
+        df[c] = df[c].where(df[c].isna(), df[c].astype(str))
+    return df
+
+
+def import_arrow():
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError('pyarrow is required for parquet and feather storage, use csv storage or install it') from e
+
+    return pyarrow
@@ -0,0 +1,210 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from Tran import GDAX_CLMN
+
+
+class FillGenerator:
+    """
+    Seeded generator of realistic looking GDAX fills and Coinbase TRX/TAX exports:
+    USD and BTC pairs, orders split into partial fills, maker (no fee) and taker fills,
+    card buys/sells and transfers from/to GDAX and external wallets
+    """
+
+    PRODUCTS = ['BTC-USD', 'ETH-USD', 'LTC-USD', 'ETH-BTC', 'LTC-BTC']
+
+    # (base USD price, yearly swing) of the deterministic price curve
+    PRICE_CURVES = {
+        'BTC': (5000.0, 0.6),
+        'ETH': (300.0, 0.8),
+        'LTC': (60.0, 0.7),
+        'BCH': (800.0, 0.7),
+    }
+
+    TRX_COLUMNS = ['Timestamp', 'Balance', 'Amount', 'Currency', 'To', 'Notes', 'Instantly Exchanged',
+                   'Transfer Total', 'Transfer Total Currency', 'Transfer Fee', 'Transfer Fee Currency',
+                   'Transfer Payment Method', 'Transfer ID', 'Order Tracking Code', 'Coinbase ID', 'Bitcoin Hash']
+
+    TAX_COLUMNS = ['Timestamp', 'Received Transaction ID', 'Received Description', 'Received Price Per Coin (USD)',
+                   'Sent Transaction ID', 'Sent Description', 'Sent Total (USD)']
+
+    TIME_FMT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+    def __init__(self, seed=0, start='2017-01-01', days=365):
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.start = pd.Timestamp(start, tz='UTC')
+        self.days = days
+
+    @staticmethod
+    def epoch_seconds(dates):
+        dates = pd.to_datetime(pd.Series(dates))
+        return ((dates - pd.Timestamp(0, tz=dates.dt.tz)) // pd.Timedelta(seconds=1)).values
+
+    @staticmethod
+    def usd_price(currency, secs):
+        """
+        Deterministic USD price of the currency at the given epoch seconds
+        """
+        if currency == 'USD':
+            return np.ones(len(secs))
+
+        base, swing = FillGenerator.PRICE_CURVES[currency]
+        days = np.asarray(secs, dtype=float) / 86400
+        return base * np.exp(swing * np.sin(days / 58.0) + 0.1 * np.sin(days * 3.7 + len(currency)))
+
+    def times(self, n):
+        offsets = np.sort(self.rng.integers(0, self.days * 86400 * 1000, n))
+        return self.start + pd.to_timedelta(offsets, unit='ms')
+
+    def gdax_fills(self, n, products=None, enriched=True):
+        """
+        :param n: number of fills
+        :param products: products to trade, PRODUCTS by default
+        :param enriched: add OriginalUnitPrice and TradeUnitPrice as enrich_gdax_rpt does
+        :rtype: pd.DataFrame
+        """
+        products = np.array(products or FillGenerator.PRODUCTS)
+
+        # orders are split into 1-4 partial fills at the same time and price
+        orders = max(1, n // 2)
+        fills_per_order = self.rng.integers(1, 5, orders)
+        order_ix = np.repeat(np.arange(orders), fills_per_order)[:n]
+        if len(order_ix) < n:
+            order_ix = np.concatenate([order_ix, np.arange(orders, orders + n - len(order_ix))])
+        orders = order_ix[-1] + 1
+
+        order_times = self.times(orders)
+        order_products = products[self.rng.integers(0, len(products), orders)]
+        order_sides = np.where(self.rng.random(orders) < 0.55, 'BUY', 'SELL')
+        order_taker = self.rng.random(orders) < 0.5
+
+        created_at = order_times[order_ix]
+        product = order_products[order_ix]
+        side = order_sides[order_ix]
+        taker = order_taker[order_ix]
+
+        split = np.char.partition(product.astype(str), '-')
+        size_unit = split[:, 0]
+        trade_unit = split[:, 2]
+
+        secs = FillGenerator.epoch_seconds(created_at)
+        original_usd = np.empty(n)
+        trade_usd = np.empty(n)
+        for cur in np.unique(np.concatenate([size_unit, trade_unit])):
+            original_usd[size_unit == cur] = FillGenerator.usd_price(cur, secs[size_unit == cur])
+            trade_usd[trade_unit == cur] = FillGenerator.usd_price(cur, secs[trade_unit == cur])
+
+        usd_quote = trade_unit == 'USD'
+        price = np.where(usd_quote, np.round(original_usd / trade_usd, 2), np.round(original_usd / trade_usd, 5))
+        size = np.round(self.rng.lognormal(-1.5, 1.2, n) * np.where(size_unit == 'BTC', 1, 10), 8) + 1e-8
+        value = size * price
+        fee = np.where(taker, np.round(value * 0.0025, 8), 0.0)
+        total = np.round(np.where(side == 'BUY', -(value + fee), value - fee), 8)
+
+        fills = pd.DataFrame({
+            GDAX_CLMN.TradeId: np.arange(1, n + 1) + self.seed * 10 ** 9,
+            GDAX_CLMN.Product: product,
+            GDAX_CLMN.Side: side,
+            GDAX_CLMN.CreatedAt: created_at.strftime(FillGenerator.TIME_FMT),
+            GDAX_CLMN.Size: size,
+            GDAX_CLMN.SizeUnit: size_unit,
+            GDAX_CLMN.Price: price,
+            GDAX_CLMN.Fee: fee,
+            GDAX_CLMN.Total: total,
+            GDAX_CLMN.TradeUnit: trade_unit
+        }, columns=GDAX_CLMN.LST_Original)
+
+        if enriched:
+            fills[GDAX_CLMN.ADV_TradeUnitPrice] = np.where(usd_quote, np.nan, np.round(trade_usd, 2))
+            fills[GDAX_CLMN.ADV_OriginalUnitPrice] = np.where(usd_quote, np.nan, np.round(original_usd, 2))
+
+        return fills
+
+    def coinbase_files(self, currency, n, directory):
+        """
+        Writes {currency}_TRX.csv and {currency}_TAX.csv the way Coinbase exports them
+        :return: paths of the TRX and TAX files
+        """
+        kinds = self.rng.choice(['buy', 'sell', 'ext_in', 'ext_out', 'gdax_in', 'gdax_out'], n,
+                                p=[0.4, 0.2, 0.1, 0.1, 0.1, 0.1])
+        times = self.times(n)
+        secs = FillGenerator.epoch_seconds(times)
+        usd = FillGenerator.usd_price(currency, secs)
+        amount = np.round(self.rng.lognormal(-1.0, 1.0, n), 8) + 1e-8
+        incoming = np.isin(kinds, ['buy', 'ext_in', 'gdax_in'])
+        traded = np.isin(kinds, ['buy', 'sell'])
+        ids = np.array(['{s:x}-{i:08d}'.format(s=self.seed, i=i) for i in range(n)])
+        timestamps = times.strftime(FillGenerator.TIME_FMT)
+
+        transfer_total = np.round(amount * usd, 2)
+        transfer_fee = np.round(transfer_total * 0.0149, 2)
+
+        trx = pd.DataFrame({c: '' for c in FillGenerator.TRX_COLUMNS}, index=range(n))
+        trx['Timestamp'] = timestamps
+        trx['Amount'] = np.where(incoming, amount, -amount)
+        trx['Currency'] = currency
+        trx['Transfer Total'] = np.where(traded, transfer_total, np.nan)
+        trx['Transfer Total Currency'] = np.where(traded, 'USD', '')
+        trx['Transfer Fee'] = np.where(traded, transfer_fee, np.nan)
+        trx['Transfer Fee Currency'] = np.where(traded, 'USD', '')
+        trx['Coinbase ID'] = ids
+        trx['Bitcoin Hash'] = np.where(np.isin(kinds, ['ext_in', 'ext_out']),
+                                       np.char.add('hash', ids.astype(str)), '')
+
+        transfers = ~traded
+        received = incoming & transfers
+        sent = ~incoming & transfers
+        tax = pd.DataFrame({
+            'Timestamp': timestamps[transfers],
+            'Received Transaction ID': np.where(received, ids, '')[transfers],
+            'Received Description': np.where(kinds == 'gdax_in', 'Received from GDAX',
+                                             np.where(received, 'Received from external wallet', ''))[transfers],
+            'Received Price Per Coin (USD)': np.where(received, np.round(usd, 2), np.nan)[transfers],
+            'Sent Transaction ID': np.where(sent, ids, '')[transfers],
+            'Sent Description': np.where(kinds == 'gdax_out', 'Sent to GDAX',
+                                         np.where(sent, 'Sent to external wallet', ''))[transfers],
+            'Sent Total (USD)': np.where(sent, transfer_total, np.nan)[transfers]
+        }, columns=FillGenerator.TAX_COLUMNS)
+
+        os.makedirs(directory, exist_ok=True)
+        trx_path = os.path.join(directory, '{c}_TRX.csv'.format(c=currency))
+        tax_path = os.path.join(directory, '{c}_TAX.csv'.format(c=currency))
+
+        with open(trx_path, 'w') as f:
+            f.write('Transactions\nUser,Synthetic\nAccount,{c} Wallet\nBalance,0\n'.format(c=currency))
+            trx.to_csv(f, index=False)
+
+        with open(tax_path, 'w') as f:
+            f.write('Coinbase tax report\nSynthetic\nBUYS\n')
+            tax.to_csv(f, index=False)
+
+        return trx_path, tax_path
+
+
+class StubReportLoader:
+    """
+    Offline stand-in for ReportLoader, fills and prices come from a FillGenerator
+    """
+
+    def __init__(self, fills=None):
+        self.fills = fills
+        self.calls = 0
+
+    def download_reports(self, products, start_date, end_date):
+        self.calls += len(products)
+        return self.fills[self.fills[GDAX_CLMN.Product].isin(products)].copy()
+
+    def getHistoricalUsdVal(self, currency, date, timedelta=15):
+        self.calls += 1
+        return round(float(FillGenerator.usd_price(currency, FillGenerator.epoch_seconds([date]))[0]), 2)
+
+    def getHistoricalCandles(self, currency, dates, timedelta=15):
+        dates = np.asarray(dates, dtype=np.int64)
+        minutes = np.unique(np.concatenate([(dates - timedelta) // 60, (dates + timedelta) // 60])) * 60
+        self.calls += len(np.unique(minutes // (300 * 60)))
+
+        mid = FillGenerator.usd_price(currency, minutes)
+        return pd.DataFrame({'time': minutes, 'low': mid * 0.998, 'high': mid * 1.002})
@@ -1,5 +1,45 @@
 import math
 
+import numpy as np
+import pandas as pd
+
+# volumes and fees are counted in integer units of 1e-8, the smallest GDAX increment, and turned
+# back into floats only for the reports. units / UNITS is the same float as round(x, 8)
+UNITS = 10 ** 8
+
+
+def round_to(values, decimals):
+    """
+    Vectorized round() with the same results as the built-in one: np.round scales the values first,
+    so halves created by the scaling are rounded to even instead of by the exact binary value
+    """
+    values = np.asarray(values, dtype=float)
+    scale = 10.0 ** decimals
+    scaled = values * scale
+
+    # exact error of the scaling product (Dekker's two-product)
+    split = 134217729.0
+    c = split * values
+    values_hi = c - (c - values)
+    values_lo = values - values_hi
+    c = split * scale
+    scale_hi = c - (c - scale)
+    scale_lo = scale - scale_hi
+    error = ((values_hi * scale_hi - scaled) + values_hi * scale_lo + values_lo * scale_hi) + values_lo * scale_lo
+
+    tie = np.abs(scaled - np.trunc(scaled)) == 0.5
+    rounded = np.where(tie & (error > 0), scaled + 0.5, np.where(tie & (error < 0), scaled - 0.5, np.rint(scaled)))
+
+    return np.where(np.abs(scaled) < 2.0 ** 52, rounded / scale, values)
+
+
+def to_units(values):
+    """
+    Amounts rounded to 8 decimals as int64 counts of UNIT, the exact integers the volume and fee arithmetic runs on.
+    Missing amounts, e.g. the USD side of a Coinbase transfer without a price, count as 0
+    """
+    return np.rint(np.nan_to_num(round_to(values, 8)) * UNITS).astype(np.int64)
+
 
 class GDAX_CLMN:
     TradeId = 'trade id'
@@ -33,6 +73,10 @@ class GDAX_CLMN:
 
 class Tran:
 
+    __slots__ = ('trade_id', 'product', 'side', 'created_at', 'size', 'size_unit', 'fee_units', 'total', 'price',
+                 'price_fee_total_unit', 'gdax_unit_price', 'gdax_trade_unit_price', '_buy_curr', '_sell_curr',
+                 'buy', 'sell')
+
     def __init__(self, data):
         self.trade_id = data[GDAX_CLMN.TradeId]
         self.product = data[GDAX_CLMN.Product]
@@ -53,6 +97,39 @@ class Tran:
         self._sell_curr = None
         self.__fill_buy_sell()
 
+    @classmethod
+    def open_lot(cls, trade_id, created_at, cur, size, vol, usd_unit_price, usd_total_price, fee, fee_unit,
+                 fee_unit_price):
+        """
+        Rebuilds what is left of a bought lot, as saved by LotEngine.checkpoint
+        """
+        t = cls.__new__(cls)
+        t.trade_id = trade_id
+        t.product = '{c}-{u}'.format(c=cur, u=fee_unit)
+        t.side = 'BUY'
+        t.created_at = created_at
+        t.size = size
+        t.size_unit = cur
+        t.fee = fee
+        t.total = usd_total_price
+        t.price = usd_unit_price
+        t.price_fee_total_unit = fee_unit
+        t.gdax_unit_price = None
+        t.gdax_trade_unit_price = fee_unit_price
+        t._buy_curr = cur
+        t._sell_curr = fee_unit
+        t.buy = TranUnit.view(cur, round(vol * UNITS), usd_total_price, usd_unit_price)
+        t.sell = None
+        return t
+
+    @property
+    def fee(self):
+        return self.fee_units / UNITS
+
+    @fee.setter
+    def fee(self, fee):
+        self.fee_units = round(fee * UNITS)
+
     def __fill_buy_sell(self):
         self.buy = TranUnit(self.buy_currency(),
                             self.size if self.buy_currency() == self.size_unit else self.total,
@@ -142,6 +219,8 @@ class Tran:
 
 class TranUnit:
 
+    __slots__ = ('cur', 'units', 'usd_total_price', 'usd_unit_price')
+
     def __init__(self, cur, vol, total_price, usd_unit_price=None):
         self.cur = cur
         self.vol = vol
@@ -149,9 +228,181 @@ class TranUnit:
         self.usd_unit_price = usd_unit_price if usd_unit_price else \
             round(self.usd_total_price / self.vol, 2 if self.cur == 'USD' else 8)
 
+    @classmethod
+    def view(cls, cur, units, usd_total_price, usd_unit_price):
+        """
+        :param units: volume as an integer count of UNIT
+        """
+        unit = cls.__new__(cls)
+        unit.cur = cur
+        unit.units = units
+        unit.usd_total_price = usd_total_price
+        unit.usd_unit_price = usd_unit_price
+        return unit
+
+    @property
+    def vol(self):
+        return self.units / UNITS
+
+    @vol.setter
+    def vol(self, vol):
+        self.units = round(vol * UNITS)
+
     def getCost(self, vol):
         return round(self.usd_unit_price * vol, 2 if self.cur == 'USD' else 8)
 
     def __str__(self):
         return '{c}@{v}/{t};{p}'.format(c=self.cur, v=self.vol, t=self.usd_unit_price, p=self.usd_total_price)
 
+
+class TranTable:
+    """
+    Columnar counterpart of Tran: one NumPy array per attribute for the whole report,
+    buy and sell currencies are stored as categorical codes into ``currencies``
+    """
+
+    def __init__(self, rpt):
+        """
+
+        :param rpt:
+        :type rpt: pd.DataFrame
+        """
+        products = rpt[GDAX_CLMN.Product].astype(str).str.split('-', n=1, expand=True)
+        base = products[0].values if len(rpt) else np.array([], dtype=object)
+        quote = products[1].values if len(rpt) else np.array([], dtype=object)
+
+        def column(name, default):
+            return rpt[name].values if name in rpt else default
+
+        self.trade_id = rpt[GDAX_CLMN.TradeId].values
+        self.product = rpt[GDAX_CLMN.Product].values
+        self.side = rpt[GDAX_CLMN.Side].values
+        self.created_at = rpt[GDAX_CLMN.CreatedAt].reset_index(drop=True)
+        self.size = round_to(np.abs(rpt[GDAX_CLMN.Size].values.astype(float)), 8)
+        self.size_unit = column(GDAX_CLMN.SizeUnit, base)
+        self.fee_units = to_units(column(GDAX_CLMN.Fee, np.zeros(len(rpt))).astype(float))
+        self.total = round_to(np.abs(rpt[GDAX_CLMN.Total].values.astype(float)), 8)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.price = round_to(column(GDAX_CLMN.Price, self.total / self.size).astype(float), 8)
+
+        self.price_fee_total_unit = column(GDAX_CLMN.TradeUnit, quote)
+        self.has_usd_prices = GDAX_CLMN.ADV_OriginalUnitPrice in rpt, GDAX_CLMN.ADV_TradeUnitPrice in rpt
+        self.gdax_unit_price = column(GDAX_CLMN.ADV_OriginalUnitPrice, np.full(len(rpt), np.nan)).astype(float)
+        self.gdax_trade_unit_price = column(GDAX_CLMN.ADV_TradeUnitPrice, np.full(len(rpt), np.nan)).astype(float)
+
+        buy_side = self.side == 'BUY'
+        buy_curr = np.where(buy_side, base, quote)
+        sell_curr = np.where(buy_side, quote, base)
+        self.currencies = pd.Index(pd.unique(np.concatenate([buy_curr, sell_curr])))
+        self.buy_curr = self.currencies.get_indexer(buy_curr)
+        self.sell_curr = self.currencies.get_indexer(sell_curr)
+
+        self.usd_unit = self.price_fee_total_unit == 'USD'
+        usd_price = np.where(self.usd_unit, self.total, round_to(self.size * self.gdax_unit_price, 8))
+
+        size_units = to_units(self.size)
+        total_units = to_units(self.total)
+
+        self.buy_units = np.where(buy_curr == self.size_unit, size_units, total_units)
+        self.buy_usd_total_price = usd_price.copy()
+        self.buy_usd_unit_price = self.__unit_prices(self.buy_usd_total_price, self.buy_vol, buy_curr)
+
+        self.sell_units = np.where(sell_curr == self.size_unit, size_units, total_units)
+        self.sell_usd_total_price = usd_price.copy()
+        self.sell_usd_unit_price = self.__unit_prices(self.sell_usd_total_price, self.sell_vol, sell_curr)
+
+    def __len__(self):
+        return len(self.size)
+
+    @property
+    def fee(self):
+        return self.fee_units / UNITS
+
+    @property
+    def buy_vol(self):
+        return self.buy_units / UNITS
+
+    @property
+    def sell_vol(self):
+        return self.sell_units / UNITS
+
+    @staticmethod
+    def __unit_prices(usd_total_price, vol, curr):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            unit_price = usd_total_price / vol
+        return np.where(curr == 'USD', round_to(unit_price, 2), round_to(unit_price, 8))
+
+    def currency_code(self, curr):
+        return self.currencies.get_loc(curr) if curr in self.currencies else -1
+
+    def tran_usd_fee(self):
+        with np.errstate(invalid='ignore'):
+            return np.where(self.usd_unit, self.fee, self.fee * self.gdax_trade_unit_price) * (self.size / self.size)
+
+    def convert_fee_to_base(self, curr):
+        has_fee = self.fee_units > 0
+        to_buy = has_fee & (self.buy_curr == self.currency_code(curr))
+        to_sell = has_fee & ~to_buy
+        usd_fee = self.tran_usd_fee()
+        buy_vol, sell_vol = self.buy_vol, self.sell_vol
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.buy_usd_total_price[to_buy] = self.buy_usd_total_price[to_buy] + usd_fee[to_buy]
+            self.buy_usd_unit_price[to_buy] = round_to(self.buy_usd_total_price[to_buy] / buy_vol[to_buy], 8)
+
+            self.sell_usd_total_price[to_sell] = self.sell_usd_total_price[to_sell] - usd_fee[to_sell]
+            self.sell_usd_unit_price[to_sell] = round_to(self.sell_usd_total_price[to_sell] / sell_vol[to_sell], 8)
+
+        self.fee_units[has_fee] = 0
+        return self
+
+    def convert_to_tax_tran(self, curr):
+        self.convert_fee_to_base(curr)
+
+        is_buy = self.buy_curr == self.currency_code(curr)
+        usd_total_price = np.where(is_buy, self.buy_usd_total_price, self.sell_usd_total_price)
+
+        return pd.DataFrame({
+            GDAX_CLMN.TradeId: self.trade_id,
+            GDAX_CLMN.Product: curr + '-USD',
+            GDAX_CLMN.Side: np.where(is_buy, 'BUY', 'SELL'),
+            GDAX_CLMN.CreatedAt: self.created_at,
+            GDAX_CLMN.Size: np.where(is_buy, self.buy_units, self.sell_units) / UNITS,
+            GDAX_CLMN.Total: np.where(self.usd_unit, round_to(usd_total_price, 2), round_to(usd_total_price, 8))
+        })
+
+    def trans(self):
+        """
+        Yields a Tran for every row, built from the table without going through the DataFrame
+        """
+        columns = [self.trade_id, self.product, self.side, self.created_at, self.size, self.size_unit,
+                   self.fee_units, self.total, self.price, self.price_fee_total_unit, self.gdax_unit_price,
+                   self.gdax_trade_unit_price, self.currencies.values[self.buy_curr],
+                   self.currencies.values[self.sell_curr], self.buy_units, self.buy_usd_total_price,
+                   self.buy_usd_unit_price, self.sell_units, self.sell_usd_total_price, self.sell_usd_unit_price]
+        has_unit_price, has_trade_unit_price = self.has_usd_prices
+
+        for (trade_id, product, side, created_at, size, size_unit, fee_units, total, price, unit, unit_price,
+             trade_unit_price, buy_curr, sell_curr, buy_units, buy_total, buy_unit, sell_units, sell_total,
+             sell_unit) in zip(*[c.tolist() for c in columns]):
+
+            t = Tran.__new__(Tran)
+            t.trade_id = trade_id
+            t.product = product
+            t.side = side
+            t.created_at = created_at
+            t.size = size
+            t.size_unit = size_unit
+            t.fee_units = fee_units
+            t.total = total
+            t.price = price
+            t.price_fee_total_unit = unit
+            t.gdax_unit_price = unit_price if has_unit_price else None
+            t.gdax_trade_unit_price = trade_unit_price if has_trade_unit_price else None
+            t._buy_curr = buy_curr
+            t._sell_curr = sell_curr
+            t.buy = TranUnit.view(buy_curr, buy_units, buy_total, buy_unit)
+            t.sell = TranUnit.view(sell_curr, sell_units, sell_total, sell_unit)
+            yield t
+
@@ -0,0 +1,192 @@
+import gzip
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+class GdaxTransport:
+    """
+    The GDAX API and the report file downloads, the only place ReportLoader touches the network
+    """
+
+    MAX_CONNECTIONS = 4
+
+    def __init__(self, passphrase, key, b64secret):
+        import gdax
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.private = gdax.AuthenticatedClient(key=key, b64secret=b64secret, passphrase=passphrase)
+        self.public = gdax.PublicClient()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=GdaxTransport.MAX_CONNECTIONS,
+                              pool_maxsize=GdaxTransport.MAX_CONNECTIONS)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def create_report(self, product, start_date, end_date):
+        """
+        :return: report id
+        """
+        result = self.private.create_report(
+            report_type="fills",
+            start_date=GdaxTransport.day(start_date),
+            end_date=GdaxTransport.day(end_date),
+            product_id=product,
+            report_format='csv')
+        return result['id']
+
+    @staticmethod
+    def day(date):
+        """
+        Reports are asked for by day, e.g. '2017-12-31', whether the date is a date or a midnight Timestamp
+        """
+        return pd.Timestamp(date).date().isoformat()
+
+    def get_report(self, report_id):
+        return self.private.get_report(report_id)
+
+    def download(self, url, file):
+        """
+        Streams the report csv at url into the binary file object
+        """
+        with self.session.get(url, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            shutil.copyfileobj(response.raw, file)
+
+    @contextmanager
+    def open_report(self, url):
+        """
+        Binary stream of the report csv, pd.read_csv parses it without buffering the whole body
+        """
+        with self.session.get(url, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            yield response.raw
+
+    def historic_rates(self, product, start, end, granularity):
+        return self.public.get_product_historic_rates(product, start=start, end=end, granularity=granularity)
+
+
+class ResponseArchive:
+    """
+    Directory of gzipped responses: report csvs under reports/ and candle pages as json under candles/,
+    named after the request, so the same request is served the same response
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def report_path(self, product, start_date, end_date):
+        return self.__path('reports', '{p}_{s}_{e}.csv.gz'.format(p=product, s=start_date, e=end_date))
+
+    def candles_path(self, product, start, end, granularity):
+        return self.__path('candles', '{p}_{s}_{e}_{g}.json.gz'.format(
+            p=product, s=ResponseArchive.epoch(start), e=ResponseArchive.epoch(end), g=granularity))
+
+    @staticmethod
+    def epoch(date):
+        """
+        Seconds of the ISO string or datetime, naive ones are UTC
+        """
+        return int(pd.Timestamp(date).timestamp())
+
+    def __path(self, folder, name):
+        return os.path.join(self.path, folder, re.sub(r'[^0-9A-Za-z_.-]+', '-', name))
+
+
+class RecordingTransport:
+    """
+    Passes every request on to another transport and stores its response in the archive
+    """
+
+    def __init__(self, transport, archive_path):
+        self.transport = transport
+        self.archive = ResponseArchive(archive_path)
+        self.reports = {}
+        self._lock = threading.Lock()
+
+    def create_report(self, product, start_date, end_date):
+        report_id = self.transport.create_report(product, start_date, end_date)
+        with self._lock:
+            self.reports[report_id] = (product, start_date, end_date)
+        return report_id
+
+    def get_report(self, report_id):
+        result = self.transport.get_report(report_id)
+        if result.get('status') == 'ready':
+            with self._lock:
+                self.reports[result['file_url']] = self.reports[report_id]
+        return result
+
+    def open_report(self, url):
+        path = self.archive.report_path(*self.reports[url])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with gzip.open(path + '.part', 'wb') as f:
+            self.transport.download(url, f)
+        os.replace(path + '.part', path)
+
+        return gzip.open(path, 'rb')
+
+    def historic_rates(self, product, start, end, granularity):
+        result = self.transport.historic_rates(product, start, end, granularity)
+
+        path = self.archive.candles_path(product, start, end, granularity)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path, 'wt') as f:
+            json.dump(result, f)
+
+        return result
+
+
+class ReplayTransport:
+    """
+    Serves the responses of a RecordingTransport archive without any network, reports are ready at once.
+    The calls still go through the RateLimiter buckets of ReportLoader, with those and a simulated latency
+    profiles of the download and enrichment stages stay comparable to live runs
+    """
+
+    def __init__(self, archive_path, latency=0):
+        """
+
+        :param latency: seconds every request takes
+        """
+        self.archive = ResponseArchive(archive_path)
+        self.latency = latency
+
+    def create_report(self, product, start_date, end_date):
+        self.__wait()
+        return self.archive.report_path(product, start_date, end_date)
+
+    def get_report(self, report_id):
+        self.__wait()
+        return {'id': report_id, 'status': 'ready', 'file_url': report_id}
+
+    def open_report(self, url):
+        self.__wait()
+        return gzip.open(ReplayTransport.__recorded(url), 'rb')
+
+    def historic_rates(self, product, start, end, granularity):
+        self.__wait()
+        with gzip.open(ReplayTransport.__recorded(self.archive.candles_path(product, start, end, granularity)),
+                       'rt') as f:
+            return json.load(f)
+
+    @staticmethod
+    def __recorded(path):
+        if not os.path.exists(path):
+            raise FileNotFoundError('{p} was not recorded'.format(p=path))
+        return path
+
+    def __wait(self):
+        if self.latency:
+            time.sleep(self.latency)
@@ -0,0 +1,145 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+import main
+from ReportProcessor import ReportProcessor as rp
+from SyntheticData import FillGenerator, StubReportLoader
+
+SIZES = [1000, 10000, 100000]
+STAGES = ['convert_cb_to_gdax', 'enrich_gdax_rpt', 'convert_to_tax_transactions', 'get_profit_loss',
+          'merge_tax_reports']
+
+CURRENCY = 'BTC'
+START = pd.Timestamp('2017-01-01', tz='UTC')
+END = pd.Timestamp('2017-12-31', tz='UTC')
+
+
+def measure(func, memory=True):
+    """
+    Times func, then runs it again under tracemalloc for the peak memory, tracing slows python code down too much
+    to time it at the same pass
+    :return: seconds and peak of traced memory in bytes
+    """
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+
+    if not memory:
+        return elapsed, None
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return elapsed, peak
+
+
+def run_size(rows, seed, work_dir, memory=True):
+    generator = FillGenerator(seed)
+    fills = generator.gdax_fills(rows)
+    raw_fills = generator.gdax_fills(rows, enriched=False)
+    trx_path, tax_path = generator.coinbase_files(CURRENCY, rows, os.path.join(work_dir, 'coinbase'))
+
+    processor = rp(StubReportLoader(raw_fills))
+    stages = {
+        'convert_cb_to_gdax': lambda: processor.convert_cb_to_gdax(trx_path, tax_path),
+        'enrich_gdax_rpt': lambda: processor.enrich_gdax_rpt(raw_fills.copy(), batched=True),
+        'convert_to_tax_transactions': lambda: processor.convert_to_tax_transactions(fills, CURRENCY),
+        'get_profit_loss': lambda: processor.get_profit_loss(fills, CURRENCY, START, END),
+        'merge_tax_reports': lambda: main.merge_tax_reports(START, END),
+    }
+
+    results = {}
+    for stage in STAGES:
+        if stage == 'merge_tax_reports':
+            write_tax_reports(processor, fills)
+
+        elapsed, peak = measure(stages[stage], memory)
+        results[stage] = {
+            'rows': rows,
+            'seconds': round(elapsed, 4),
+            'peak_mb': round(peak / 2 ** 20, 2) if peak is not None else None,
+            'rows_per_sec': round(rows / elapsed) if elapsed > 0 else None
+        }
+
+    return results
+
+
+def write_tax_reports(processor, fills):
+    for cur in main.CURRENCIES:
+        tax_trans = processor.convert_to_tax_transactions(fills, cur)
+        main.STORAGE.write(tax_trans, main.make_path(main.PATH_TRANS_TAX, cur, START, END))
+
+        gain_loss_tax = processor.get_profit_loss(fills, cur, START, END)[1]
+        if len(gain_loss_tax) > 0:
+            main.STORAGE.write(gain_loss_tax, main.make_path(main.PATH_GL_TAX, cur, START, END),
+                               columns=main.GL_TAX_COLUMNS)
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: stages which got slower than the baseline by more than the tolerance
+    """
+    regressions = []
+    for key, result in results.items():
+        if key in baseline and result['seconds'] > baseline[key]['seconds'] * (1 + tolerance):
+            regressions.append((key, baseline[key]['seconds'], result['seconds']))
+
+    return regressions
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='Benchmark of the gain/loss pipeline on synthetic fills')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='number of rows, 1k to 1M')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write results as a baseline json')
+    parser.add_argument('--compare', help='baseline json to compare the results with')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip the peak memory pass')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='gainloss-bench-')
+    results = {}
+
+    try:
+        os.chdir(work_dir)
+        for rows in args.sizes:
+            for stage, result in run_size(rows, args.seed, work_dir, args.memory).items():
+                results['{s}/{r}'.format(s=stage, r=rows)] = result
+                print('{s:<30} {r:>9} rows {t:>10.3f} s {m:>10} MB {p:>12} rows/s'.format(
+                    s=stage, r=rows, t=result['seconds'], m=str(result['peak_mb']), p=str(result['rows_per_sec'])))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        for key, before, after in regressions:
+            print('REGRESSION {k}: {b:.3f} s -> {a:.3f} s'.format(k=key, b=before, a=after))
+
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main_benchmark()
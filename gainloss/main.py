@@ -1,19 +1,85 @@
+import argparse
 import datetime
+import logging
+import sys
+import time
 
 import pandas as pd
 import os
+from concurrent.futures import ProcessPoolExecutor
 
-from ReportLoader import ReportLoader as rpl
 from ReportProcessor import ReportProcessor as rp
+from PriceCache import PriceCache
+from Tran import GDAX_CLMN
+from LotEngine import LotEngine
+from Storage import get_storage, STORAGES
+from Metrics import metrics
+from SortedMerge import merge_sorted, frame_chunks
+import RateLimiter
 
 PATH_TRANS_TAX = './data/results_tax/'
 PATH_GL_TAX = './data/results_tax_gl/'
 PATH_RESULTS = './data/results/'
 PATH_GDAX_ENRICHED = './data/enriched_gdax/'
+PATH_GDAX_PRODUCTS = './data/enriched_products/'
+PATH_GDAX_DOWNLOADS = './data/gdax/'
+PATH_PRICE_CACHE = './data/price_cache.sqlite'
+PATH_CHECKPOINT = './data/checkpoints/'
+PATH_METRICS = './data/metrics.json'
+PATH_CONFIG = './data/gdax_conf.yaml'
 
+HISTORY_START = datetime.date(2016, 12, 31)
+
+# default tax period of the command line
+START_DATE = '2017-01-01'
+END_DATE = '2017-12-31'
+
+WORKERS = 4
+
+# storage of the intermediate reports: csv, parquet or feather
+STORAGE = get_storage('csv')
+
+# total reports are merged from the sorted per currency reports in chunks of this many rows
+MERGE_STREAMING = True
+MERGE_CHUNK_SIZE = 100000
+
+# rows per chunk of the streaming mode for very large fills histories: fills are enriched, matched and written
+# chunk by chunk with only the open lots kept between chunks, the GDAX report of a single product is downloaded
+# at a time. None keeps every report in memory
+CHUNK_SIZE = None
+
+# GDAX responses are stored in this archive directory, or served from it without any network
+RECORD_ARCHIVE = None
+REPLAY_ARCHIVE = None
+# seconds every replayed request takes
+REPLAY_LATENCY = 0
+
+# accounts of a batch run are run on a pool of this many worker processes
+BATCH_WORKERS = 4
+BATCH_SUMMARY_COLUMNS = ['Account', 'Root', 'Gains', 'Seconds', 'Error']
+
+# pipeline stages to run under cProfile, e.g. 'lot_matching' or 'enrichment'
+PROFILE_STAGES = []
+
+# dates of the file names, the command line timestamps are named after their day as the dates of earlier runs
+FILE_DATE_FMT = '%Y-%m-%d'
 FILE_NAME_TPL = '{c}_{ds}--{de}.csv'
 FILE_NAME_TPL_ALT = '{c}_{ds}--{de}_alt.csv'
 FILE_NAME_TPL_TOTAL = 'TOTAL_{ds}--{de}.csv'
+FILE_NAME_TPL_CHECKPOINT = '{c}_{de}.csv'
+FILE_NAME_TPL_METHODS = 'METHODS_{ds}--{de}.csv'
+FILE_NAME_TPL_POSITIONS = 'POSITIONS_{ds}--{de}.csv'
+
+# lot selection method per currency: fifo, lifo, hifo (highest cost first) or lofo (lowest cost first)
+LOT_METHODS = {
+        'BCH': LotEngine.FIFO,
+        'LTC': LotEngine.FIFO,
+        'ETH': LotEngine.FIFO,
+        'BTC': LotEngine.FIFO
+    }
+
+# columns of the enriched reports the lot matching reads, the comparison and the snapshots load only these
+LOT_COLUMNS = GDAX_CLMN.LST_Original + [GDAX_CLMN.ADV_OriginalUnitPrice, GDAX_CLMN.ADV_TradeUnitPrice]
 
 GL_TAX_COLUMNS = ['Description', 'Date Aquired', 'Date Sold', 'Proceeds', 'Cost', 'Gain or Loss', 'Tran DT']
 
@@ -24,55 +90,633 @@ CURRENCIES = {
         'BTC': ['BTC-USD', 'ETH-BTC', 'LTC-BTC']
     }
 
-def main():
-    loader = rpl.from_config('./data/gdax_conf.yaml')
-    report_processor = rp(loader)
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    for stage in PROFILE_STAGES + args.profile:
+        metrics.profile(stage)
+
+    configure(args)
+    args.command(args)
+
+    print(metrics.to_json(PATH_METRICS))
+
+
+def parse_args(argv=None):
+    """
+    Without a command the whole pipeline runs, as the run command with its defaults
+    """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--start', type=parse_date, default=START_DATE,
+                        help='first day of the tax period, YYYY-MM-DD')
+    common.add_argument('--end', type=parse_date, default=END_DATE,
+                        help='last day of the tax period, YYYY-MM-DD')
+    common.add_argument('--currencies', nargs='+', choices=list(CURRENCIES), default=list(CURRENCIES))
+    common.add_argument('--root', default='.', help='directory of the ./data tree the reports are read from and '
+                                                    'written to')
+    common.add_argument('--storage', choices=list(STORAGES), help='storage of the intermediate reports, csv by default')
+    common.add_argument('--checkpoint-date', type=parse_date,
+                        help='end date of a previous run, its open lots checkpoint is used and only later fills '
+                             'are downloaded and processed')
+    common.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='stream the reports in chunks of this many rows')
+    common.add_argument('--workers', type=int, default=WORKERS)
+    common.add_argument('--profile', action='append', default=[], metavar='STAGE',
+                        help='run the pipeline stage under cProfile, e.g. lot_matching or enrichment')
+
+    config = argparse.ArgumentParser(add_help=False)
+    config.add_argument('--config', help='GDAX API key config, {p} under the root by default'.format(p=PATH_CONFIG))
+    transport = config.add_mutually_exclusive_group()
+    transport.add_argument('--record', metavar='ARCHIVE', help='store every GDAX response in the archive directory')
+    transport.add_argument('--replay', metavar='ARCHIVE',
+                           help='serve the GDAX responses recorded in the archive, offline and without a config. '
+                                'Prices found in the price cache are not requested, so record and replay with the '
+                                'same cache')
+    config.add_argument('--latency', type=float, default=0, help='seconds every replayed request takes')
+    config.add_argument('--rate-limits', action='store_true', help='keep the GDAX rate limits while replaying')
+
+    parser = argparse.ArgumentParser(description='GDAX and Coinbase gain/loss calculator for taxes')
+    commands = parser.add_subparsers(title='commands')
+
+    download = commands.add_parser('download', parents=[common, config],
+                                   help='download the fills of every product not downloaded yet')
+    download.set_defaults(command=download_command)
+
+    enrich = commands.add_parser('enrich', parents=[common, config],
+                                 help='add USD prices to the fills and merge them with the coinbase reports')
+    enrich.set_defaults(command=enrich_command)
+
+    compute = commands.add_parser('compute', parents=[common, config],
+                                  help='match lots of the enriched reports, offline unless --positions is given')
+    compute.add_argument('--compare-methods', action='store_true',
+                         help='also write gains of every lot selection method side by side, from the whole history '
+                              'so not with --checkpoint-date')
+    compute.add_argument('--positions', action='store_true',
+                         help='also write open positions and unrealized gains at every month end')
+    compute.set_defaults(command=compute_command)
+
+    merge = commands.add_parser('merge', parents=[common], help='merge the per currency tax reports')
+    merge.set_defaults(command=merge_command)
+
+    run = commands.add_parser('run', parents=[common, config], help='the whole pipeline, the default')
+    run.add_argument('--no-enrich', dest='enrich', action='store_false',
+                     help='compute from the enriched reports of a previous run')
+    run.add_argument('--compare-methods', action='store_true')
+    run.add_argument('--positions', action='store_true')
+    run.add_argument('--account', nargs=2, action='append', metavar=('CONFIG', 'ROOT'),
+                     help='run the accounts as a batch on a worker pool, every account writes under its root')
+    run.add_argument('--batch-workers', type=int, default=BATCH_WORKERS)
+    run.set_defaults(command=run_command)
+
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser.parse_args(argv or ['run'])
+
+    if getattr(args, 'compare_methods', False) and args.checkpoint_date:
+        parser.error('--compare-methods needs the whole history, it cannot be used with --checkpoint-date')
+
+    return args
+
+
+def parse_date(value):
+    """
+    Dates of the command line are UTC midnights, the reports are compared with them in UTC. File names only
+    use their day, see make_path
+    """
+    return pd.Timestamp(datetime.date.fromisoformat(value), tz='UTC')
+
+
+def configure(args):
+    global STORAGE, CURRENCIES, RECORD_ARCHIVE, REPLAY_ARCHIVE, REPLAY_LATENCY
+
+    # paths of the arguments are relative to the directory the command was started in
+    if getattr(args, 'config', None):
+        args.config = os.path.abspath(args.config)
+    if getattr(args, 'record', None):
+        RECORD_ARCHIVE = os.path.abspath(args.record)
+    if getattr(args, 'replay', None):
+        REPLAY_ARCHIVE = os.path.abspath(args.replay)
+        REPLAY_LATENCY = args.latency
+
+        if not args.rate_limits:
+            RateLimiter.install({group: None for group in RateLimiter.BUCKETS})
+    if getattr(args, 'account', None):
+        args.account = [(os.path.abspath(config_path), os.path.abspath(root)) for config_path, root in args.account]
+
+    os.chdir(args.root)
+
+    if 'config' in args and args.config is None:
+        args.config = PATH_CONFIG
+
+    if args.storage:
+        STORAGE = get_storage(args.storage)
+    CURRENCIES = {cur: CURRENCIES[cur] for cur in args.currencies}
+
+
+def download_command(args):
+    processor = rp(make_loader(args.config))
+    download_products(processor, args.checkpoint_date or HISTORY_START, args.end, unique_products())
+
+
+def enrich_command(args):
+    price_cache = PriceCache(PATH_PRICE_CACHE)
+    processor = rp(make_loader(args.config, price_cache))
+    history_start = args.checkpoint_date or HISTORY_START
+
+    product_data = load_products(processor, history_start, args.end, unique_products(), args.chunk_size)
+    cb_data = load_coinbase_reports(processor) if args.chunk_size is None else None
 
+    for cur, products in CURRENCIES.items():
+        if args.chunk_size:
+            merge_gain_loss_data_streaming(processor, args.start, args.end, cur, products, args.chunk_size,
+                                           history_start)
+        else:
+            load_gain_loss_data(processor, args.start, args.end, cur, products, True, product_data, history_start,
+                                cb_data)
 
-    # start_date = datetime.date(2016, 12, 31)
-    start_date = datetime.date(2017, 1, 1)
-    end_date = datetime.date(2017, 12, 31)
+    print('Price cache: {stats}'.format(stats=price_cache.stats()))
+    price_cache.close()
 
 
+def compute_command(args):
+    price_cache = PriceCache(PATH_PRICE_CACHE) if args.positions else None
 
-    enrich = True
+    run_account(args.config, args.start, args.end, price_cache, False, args.workers, args.compare_methods,
+                args.checkpoint_date, args.chunk_size, args.positions, merge=False)
 
-    total_gains = 0
+    if price_cache is not None:
+        price_cache.close()
 
-    for cur, products in CURRENCIES.items():
-        total_gains += create_gain_loss_report(report_processor, start_date, end_date, cur, products, enrich)
+
+def merge_command(args):
+    merge_tax_reports(args.start, args.end)
+
+
+def run_command(args):
+    if args.account:
+        summary = run_accounts(args.account, args.start, args.end, args.batch_workers, enrich=args.enrich,
+                               compare_methods=args.compare_methods, positions=args.positions,
+                               checkpoint_date=args.checkpoint_date, chunk_size=args.chunk_size)
+        print(summary.to_string(index=False))
+        return
+
+    price_cache = PriceCache(PATH_PRICE_CACHE)
+
+    run_account(args.config, args.start, args.end, price_cache, args.enrich, args.workers, args.compare_methods,
+                args.checkpoint_date, args.chunk_size, args.positions)
+
+    print('Price cache: {stats}'.format(stats=price_cache.stats()))
+    price_cache.close()
+
+
+def make_loader(config_path, price_cache=None):
+    """
+    The GDAX client, its network and yaml libraries are only imported by the commands which need them
+    """
+    from ReportLoader import ReportLoader
+    from Transport import RecordingTransport, ReplayTransport
+
+    if REPLAY_ARCHIVE:
+        return ReportLoader(price_cache=price_cache, transport=ReplayTransport(REPLAY_ARCHIVE, REPLAY_LATENCY))
+
+    loader = ReportLoader.from_config(config_path, price_cache)
+    if RECORD_ARCHIVE:
+        loader.transport = RecordingTransport(loader.transport, RECORD_ARCHIVE)
+
+    return loader
+
+
+def run_account(config_path, start_date, end_date, price_cache=None, enrich=True, workers=WORKERS,
+                compare_methods=False, checkpoint_date=None, chunk_size=CHUNK_SIZE, positions=False, merge=True):
+    """
+    Whole pipeline for the account of the config, reports are written under ./data
+    :param merge: also merge the per currency tax reports
+    :return: total gains
+    """
+    if compare_methods and checkpoint_date:
+        # the checkpoint holds the open lots of a single method, the others would start from the wrong lots
+        raise ValueError('compare_methods needs the whole history, it cannot be used with a checkpoint_date')
+
+    # an offline recompute doesn't need the GDAX client
+    loader = make_loader(config_path, price_cache) if enrich or positions else None
+    report_processor = rp(loader)
+
+    history_start = checkpoint_date or HISTORY_START
+
+    # every product is downloaded and enriched once, even if it is listed under several currencies
+    product_data = load_products(report_processor, history_start, end_date, unique_products(),
+                                 chunk_size) if enrich else None
+    cb_data = load_coinbase_reports(report_processor) if enrich and chunk_size is None else None
+
+    if chunk_size:
+        total_gains = 0
+
+        for cur, products in CURRENCIES.items():
+            total_gains += create_gain_loss_report_streaming(report_processor, start_date, end_date, cur, products,
+                                                             enrich, chunk_size, checkpoint_date)
+    elif workers > 1:
+        total_gains = create_gain_loss_reports_parallel(report_processor, start_date, end_date, enrich, workers,
+                                                        product_data, checkpoint_date, cb_data)
+    else:
+        total_gains = 0
+
+        for cur, products in CURRENCIES.items():
+            total_gains += create_gain_loss_report(report_processor, start_date, end_date, cur, products, enrich,
+                                                   product_data, checkpoint_date, cb_data)
 
     print('Total gains: {gain}'.format(gain=total_gains))
 
-    merge_tax_reports(start_date, end_date)
+    if merge:
+        merge_tax_reports(start_date, end_date)
+
+    if compare_methods:
+        print(compare_lot_methods(report_processor, start_date, end_date))
+
+    if positions:
+        print(snapshot_positions(report_processor, start_date, end_date, checkpoint_date=checkpoint_date))
+
+    return total_gains
+
+
+def run_accounts(accounts, start_date, end_date, workers=BATCH_WORKERS, **options):
+    """
+    Runs many accounts on a pool of worker processes. Every worker imports the libraries once and serves
+    several accounts, all of them share the price cache file at PATH_PRICE_CACHE and the rate limit buckets.
+    A failing account is reported in the summary and doesn't stop the others
+
+    :param accounts: (config path, output root) pairs, the reports of an account are written under
+    its output root, which also holds its data/coinbase exports
+    :param options: run_account arguments, e.g. enrich or checkpoint_date
+    :return: gains, seconds and error of every account
+    :rtype: pd.DataFrame
+    """
+    accounts = [(os.path.abspath(config_path), os.path.abspath(root)) for config_path, root in accounts]
+    summary = []
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_account_worker,
+                             initargs=(os.path.abspath(PATH_PRICE_CACHE), worker_settings())) as pool:
+        futures = [pool.submit(run_account_worker, config_path, root, start_date, end_date, options)
+                   for config_path, root in accounts]
+
+        for (config_path, root), f in zip(accounts, futures):
+            try:
+                result, worker_metrics = f.result()
+                metrics.merge(worker_metrics)
+            except Exception as e:  # the worker process itself died
+                result = {'Gains': None, 'Seconds': None, 'Error': repr(e)}
+
+            summary.append(dict(Account=config_path, Root=root, **result))
+
+    return pd.DataFrame(summary, columns=BATCH_SUMMARY_COLUMNS)
+
 
+# price cache of a batch worker process, opened once by init_account_worker
+account_price_cache = None
 
-def create_gain_loss_report(rp, start, end, cur, products, enrich=False):
 
+def init_account_worker(price_cache_path, settings):
+    global account_price_cache
+
+    init_worker(settings)
+    account_price_cache = PriceCache(price_cache_path)
+
+
+def run_account_worker(config_path, root, start_date, end_date, options):
+    metrics.reset()
+    cwd = os.getcwd()
+    started = time.perf_counter()
+    error = None
+    gains = None
+
+    try:
+        os.makedirs(root, exist_ok=True)
+        os.chdir(root)
+        # the batch pool is the bound on parallelism, accounts don't start pools of their own
+        gains = run_account(config_path, start_date, end_date, account_price_cache, workers=1, **options)
+        metrics.to_json(PATH_METRICS)
+    except Exception as e:
+        logging.exception('Account %s failed', config_path)
+        error = repr(e)
+    finally:
+        os.chdir(cwd)
+
+    result = {'Gains': gains, 'Seconds': round(time.perf_counter() - started, 3), 'Error': error}
+    return result, metrics.snapshot()
+
+
+def create_gain_loss_report(rp, start, end, cur, products, enrich=False, product_data=None, checkpoint_date=None,
+                            cb_data=None):
+    gdax_data = load_gain_loss_data(rp, start, end, cur, products, enrich, product_data,
+                                    checkpoint_date or HISTORY_START, cb_data)
+    return compute_gain_loss_report(start, end, cur, gdax_data, rp, checkpoint_date)
+
+
+def create_gain_loss_report_streaming(rp, start, end, cur, products, enrich, chunk_size, checkpoint_date=None):
     if enrich:
-        cb_converted = rp.convert_cb_to_gdax('./data/coinbase/{c}_TRX.csv'.format(c=cur), './data/coinbase/{c}_TAX.csv'.format(c=cur))
+        merge_gain_loss_data_streaming(rp, start, end, cur, products, chunk_size, checkpoint_date or HISTORY_START)
+    return compute_gain_loss_report_streaming(start, end, cur, chunk_size, rp, checkpoint_date)
+
+
+def create_gain_loss_reports_parallel(rp, start, end, enrich, workers, product_data=None, checkpoint_date=None,
+                                      cb_data=None):
+    """
+    Network bound stages run here one currency after another, while the compute stages of the already loaded
+    currencies run on a process pool. Workers get the parent's settings and share its rate limit buckets
+    """
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(worker_settings(),)) as pool:
+        futures = [pool.submit(compute_gain_loss_report_worker, start, end, cur,
+                               load_gain_loss_data(rp, start, end, cur, products, enrich, product_data,
+                                                   checkpoint_date or HISTORY_START, cb_data),
+                               None, checkpoint_date)
+                   for cur, products in CURRENCIES.items()]
+
+        total_gains = 0
+
+        # sum in CURRENCIES order, the same as the serial run
+        for f in futures:
+            gains, worker_metrics = f.result()
+            metrics.merge(worker_metrics)
+            total_gains += gains
+
+        return total_gains
+
+
+def worker_settings():
+    """
+    The settings configure gave this process. Workers started with spawn, the default on macOS, import main
+    again and would fall back to the defaults, so every pool hands these to init_worker
+    """
+    return {
+        'storage': STORAGE.NAME,
+        'currencies': CURRENCIES,
+        'record_archive': RECORD_ARCHIVE,
+        'replay_archive': REPLAY_ARCHIVE,
+        'replay_latency': REPLAY_LATENCY,
+        'buckets': RateLimiter.BUCKETS
+    }
 
-        gdax_data = rp.rl.download_reports(products, datetime.date(2016, 12, 31), end)
 
-        gdax_data = rp.merge_reports([gdax_data, cb_converted], end)
-        gdax_data = rp.enrich_gdax_rpt(gdax_data)
+def init_worker(settings):
+    global STORAGE, CURRENCIES, RECORD_ARCHIVE, REPLAY_ARCHIVE, REPLAY_LATENCY
 
-        gdax_data.to_csv(make_path(PATH_GDAX_ENRICHED, cur, start, end), index=False)
-    else:
-        gdax_data = pd.read_csv(make_path(PATH_GDAX_ENRICHED, cur, start, end))
+    RateLimiter.install(settings['buckets'])
+    STORAGE = get_storage(settings['storage'])
+    CURRENCIES = settings['currencies']
+    RECORD_ARCHIVE = settings['record_archive']
+    REPLAY_ARCHIVE = settings['replay_archive']
+    REPLAY_LATENCY = settings['replay_latency']
+
+
+def compute_gain_loss_report_worker(*args):
+    metrics.reset()
+    gains = compute_gain_loss_report(*args)
+    return gains, metrics.snapshot()
+
+
+def unique_products():
+    return list(dict.fromkeys(p for products in CURRENCIES.values() for p in products))
 
-    tax_trans = rp.convert_to_tax_transactions(gdax_data, cur)
-    tax_trans.to_csv(make_path(PATH_TRANS_TAX, cur, start, end), index=False)
 
-    (gain_loss, gain_loss_tax) = rp.get_profit_loss(gdax_data, cur, start, end)
-    gain_loss.to_csv(make_path(PATH_RESULTS, cur, start, end), index=False)
+def download_products(rp, history_start, end, products):
+    """
+    Downloads the fills of every product not downloaded yet into PATH_GDAX_DOWNLOADS
+    """
+    missing = [p for p in products if not STORAGE.exists(make_path(PATH_GDAX_DOWNLOADS, p, history_start, end))]
+
+    if missing:
+        gdax_data = rp.rl.download_reports(missing, history_start, end)
+        gdax_data = rp.merge_reports([gdax_data], end)
+
+        for p in missing:
+            write_report(gdax_data[gdax_data[GDAX_CLMN.Product] == p], make_path(PATH_GDAX_DOWNLOADS, p, history_start, end))
+
+
+def load_products(rp, history_start, end, products, chunk_size=None):
+    """
+    Downloads and enriches the fills of every product once. Enriched products are kept in PATH_GDAX_PRODUCTS,
+    so the next run with the same dates doesn't touch the network for them again
+    :param chunk_size: download the products one by one and enrich them in chunks of this many rows, they are
+    not read into memory either: the streaming mode reads them chunk by chunk
+    :return: enriched fills by product, None with chunk_size
+    :rtype: dict
+    """
+    missing = [p for p in products if not STORAGE.exists(make_path(PATH_GDAX_PRODUCTS, p, history_start, end))]
+
+    if missing and chunk_size:
+        for p in missing:
+            download_products(rp, history_start, end, [p])
+            enrich_product_streaming(rp, p, history_start, end, chunk_size)
+    elif missing:
+        download_products(rp, history_start, end, missing)
+
+        gdax_data = pd.concat([STORAGE.read(make_path(PATH_GDAX_DOWNLOADS, p, history_start, end)) for p in missing],
+                              ignore_index=True)
+        gdax_data = rp.enrich_gdax_rpt(gdax_data, batched=True)
+
+        for p in missing:
+            path = make_path(PATH_GDAX_PRODUCTS, p, history_start, end)
+            write_report(gdax_data[gdax_data[GDAX_CLMN.Product] == p], path)
+
+    if chunk_size:
+        return None
+
+    return {p: STORAGE.read(make_path(PATH_GDAX_PRODUCTS, p, history_start, end)) for p in products}
+
+
+def enrich_product_streaming(rp, product, history_start, end, chunk_size):
+    """
+    Enriches the downloaded fills of the product chunk by chunk into PATH_GDAX_PRODUCTS. The downloads are
+    sorted by date, so the chunks are too
+    """
+    path = make_path(PATH_GDAX_DOWNLOADS, product, history_start, end)
+    # every chunk gets the USD price columns, as the products enriched together in memory do
+    columns = list(dict.fromkeys(STORAGE.columns(path) + [GDAX_CLMN.ADV_TradeUnitPrice,
+                                                          GDAX_CLMN.ADV_OriginalUnitPrice]))
+
+    with STORAGE.writer(make_path(PATH_GDAX_PRODUCTS, product, history_start, end), columns) as writer:
+        # a product without fills still gets a file with the columns only
+        writer.write(pd.DataFrame(columns=columns))
+
+        for chunk in STORAGE.read_chunks(path, chunk_size):
+            chunk = rp.enrich_gdax_rpt(chunk, batched=True)
+
+            with metrics.stage('report_write'):
+                writer.write(chunk)
+
+
+def load_gain_loss_data(rp, start, end, cur, products, enrich=False, product_data=None, history_start=HISTORY_START,
+                        cb_data=None):
+    """
+    :param cb_data: converted coinbase reports by currency, e.g. from load_coinbase_reports. The report
+    of the currency is read if None
+    """
+    if not enrich:
+        return None
+
+    if product_data is None:
+        product_data = load_products(rp, history_start, end, products)
+
+    cb_converted = cb_data[cur] if cb_data is not None else rp.convert_cb_to_gdax(*coinbase_paths(cur))
+
+    # coinbase transactions are in USD, so the merged report doesn't need any further enrichment
+    gdax_data = rp.merge_reports([product_data[p] for p in products] + [cb_converted], end)
+    gdax_data = gdax_data.sort_values(by=GDAX_CLMN.CreatedAt, kind='stable')
+
+    write_report(gdax_data, make_path(PATH_GDAX_ENRICHED, cur, start, end))
+    return gdax_data
+
+
+def load_coinbase_reports(rp):
+    """
+    Reads and converts the coinbase exports of every currency at once
+    :return: converted reports by currency
+    :rtype: dict
+    """
+    return rp.convert_cb_reports({cur: coinbase_paths(cur) for cur in CURRENCIES})
+
+
+def coinbase_paths(cur):
+    return './data/coinbase/{c}_TRX.csv'.format(c=cur), './data/coinbase/{c}_TAX.csv'.format(c=cur)
+
+
+def merge_gain_loss_data_streaming(rp, start, end, cur, products, chunk_size, history_start=HISTORY_START):
+    """
+    Streaming counterpart of load_gain_loss_data: the time sorted enriched products are merged with the coinbase
+    report chunk by chunk into the enriched report of the currency, which is never held in memory as a whole
+    """
+    cb_converted = rp.convert_cb_to_gdax(*coinbase_paths(cur))
+    cb_converted = rp.merge_reports([cb_converted], end).sort_values(by=GDAX_CLMN.CreatedAt, kind='stable')
+
+    paths = [make_path(PATH_GDAX_PRODUCTS, p, history_start, end) for p in products]
+
+    # the columns of the in-memory merge, chunks lacking some of them are aligned to these
+    columns = list(dict.fromkeys([c for path in paths for c in STORAGE.columns(path)] + list(cb_converted.columns)))
+
+    sources = [(rp.merge_reports([chunk], end) for chunk in STORAGE.read_chunks(path, chunk_size)) for path in paths]
+    sources.append(frame_chunks(cb_converted, chunk_size))
+
+    with STORAGE.writer(make_path(PATH_GDAX_ENRICHED, cur, start, end), columns) as writer:
+        for chunk in merge_sorted(sources, GDAX_CLMN.CreatedAt):
+            if len(cb_converted) > 0:
+                # gdax trade ids are integers, coinbase ones strings. Every chunk gets the type of the whole report
+                chunk[GDAX_CLMN.TradeId] = chunk[GDAX_CLMN.TradeId].where(chunk[GDAX_CLMN.TradeId].isna(),
+                                                                          chunk[GDAX_CLMN.TradeId].astype(str))
+
+            with metrics.stage('report_write'):
+                writer.write(chunk)
+
+
+def compute_gain_loss_report_streaming(start, end, cur, chunk_size, processor=None, checkpoint_date=None):
+    """
+    compute_gain_loss_report over the enriched report read chunk by chunk. Only the open lots are carried
+    from one chunk to the next, the results are appended to the reports as they are computed
+    """
+    processor = processor or rp()
+    lots = load_checkpoint(cur, checkpoint_date)
+    gains = 0
+
+    with STORAGE.writer(make_path(PATH_TRANS_TAX, cur, start, end)) as tax_trans_writer, \
+            STORAGE.writer(make_path(PATH_RESULTS, cur, start, end)) as gain_loss_writer, \
+            STORAGE.writer(make_path(PATH_GL_TAX, cur, start, end), GL_TAX_COLUMNS) as gain_loss_tax_writer:
+
+        for gdax_data in STORAGE.read_chunks(make_path(PATH_GDAX_ENRICHED, cur, start, end), chunk_size):
+            tax_trans = processor.convert_to_tax_transactions(gdax_data, cur)
+            (gain_loss, gain_loss_tax) = processor.get_profit_loss(gdax_data, cur, start, end, lots=lots)
+
+            with metrics.stage('report_write'):
+                tax_trans_writer.write(tax_trans)
+                gain_loss_writer.write(gain_loss)
+
+                # no tax report at all if nothing was sold, as in compute_gain_loss_report
+                if len(gain_loss_tax) > 0:
+                    gain_loss_tax_writer.write(gain_loss_tax)
+
+            gains += gain_loss_tax['Gain or Loss'].sum()
+
+    LotEngine.write_checkpoint(lots.checkpoint(cur),
+                               make_path(PATH_CHECKPOINT, cur, start, end, FILE_NAME_TPL_CHECKPOINT))
+
+    return round(gains, 2)
+
+
+def compute_gain_loss_report(start, end, cur, gdax_data=None, processor=None, checkpoint_date=None):
+    processor = processor or rp()
+    lots = load_checkpoint(cur, checkpoint_date)
+
+    if gdax_data is None:
+        gdax_data = STORAGE.read(make_path(PATH_GDAX_ENRICHED, cur, start, end))
+
+    tax_trans = processor.convert_to_tax_transactions(gdax_data, cur)
+    write_report(tax_trans, make_path(PATH_TRANS_TAX, cur, start, end))
+
+    (gain_loss, gain_loss_tax) = processor.get_profit_loss(gdax_data, cur, start, end, lots=lots)
+    write_report(gain_loss, make_path(PATH_RESULTS, cur, start, end))
+
+    LotEngine.write_checkpoint(lots.checkpoint(cur),
+                               make_path(PATH_CHECKPOINT, cur, start, end, FILE_NAME_TPL_CHECKPOINT))
 
     if len(gain_loss_tax) > 0:
-        gain_loss_tax.to_csv(make_path(PATH_GL_TAX, cur, start, end), index=False, columns=GL_TAX_COLUMNS)
+        write_report(gain_loss_tax, make_path(PATH_GL_TAX, cur, start, end), columns=GL_TAX_COLUMNS)
 
     return round(0 if len(gain_loss_tax) == 0 else gain_loss_tax['Gain or Loss'].sum(), 2)
 
 
+def compare_lot_methods(processor, start, end, methods=None):
+    """
+    Proceeds, cost, short and long term gains of every currency under each lot selection method,
+    computed from the enriched reports of the run, which have to cover the whole history
+    :rtype: pd.DataFrame
+    """
+    comparison = pd.concat(
+        [processor.compare_methods(read_lot_columns(make_path(PATH_GDAX_ENRICHED, cur, start, end)), cur, start, end,
+                                   methods)
+         for cur in CURRENCIES if STORAGE.exists(make_path(PATH_GDAX_ENRICHED, cur, start, end))],
+        ignore_index=True)
+
+    comparison.to_csv(make_path(PATH_RESULTS, '', start, end, FILE_NAME_TPL_METHODS), index=False)
+    return comparison
+
+
+def snapshot_positions(processor, start, end, dates=None, checkpoint_date=None):
+    """
+    Open positions and unrealized gains of every currency, computed from the enriched reports of the run
+    :param dates: month ends from HISTORY_START, or the checkpoint, to end if None
+    :param checkpoint_date: the reports only hold the fills after it, the positions start from its open lots
+    :rtype: pd.DataFrame
+    """
+    if dates is None:
+        # the last second of every month, in UTC
+        first = pd.Timestamp(checkpoint_date or HISTORY_START).replace(tzinfo=None)
+        dates = (pd.date_range(first, pd.Timestamp(end).replace(tzinfo=None), freq='ME') +
+                 pd.Timedelta(days=1) - pd.Timedelta(seconds=1))
+
+    reports = {cur: read_lot_columns(make_path(PATH_GDAX_ENRICHED, cur, start, end))
+               for cur in CURRENCIES if STORAGE.exists(make_path(PATH_GDAX_ENRICHED, cur, start, end))}
+    lots = {cur: load_checkpoint(cur, checkpoint_date) for cur in reports} if checkpoint_date else None
+    positions = processor.snapshot_positions(reports, dates, LOT_METHODS, lots=lots)
+
+    positions.to_csv(make_path(PATH_RESULTS, '', start, end, FILE_NAME_TPL_POSITIONS), index=False)
+    return positions
+
+
+def read_lot_columns(path):
+    """
+    The LOT_COLUMNS of the report the file has, unenriched reports have no USD prices
+    """
+    columns = STORAGE.columns(path)
+    return STORAGE.read(path, columns=[c for c in LOT_COLUMNS if c in columns])
+
+
+def load_checkpoint(cur, checkpoint_date=None):
+    method = LOT_METHODS.get(cur, LotEngine.FIFO)
+    if checkpoint_date is None:
+        return LotEngine(method)
+
+    checkpoint = LotEngine.read_checkpoint(make_path(PATH_CHECKPOINT, cur, checkpoint_date, checkpoint_date,
+                                                     FILE_NAME_TPL_CHECKPOINT))
+    return LotEngine.from_checkpoint(checkpoint, checkpoint_date, method)
+
+
 # def gain_loss_by_tran_report(rp, start, end, cur, products):
 #     trans = pd.read_csv(make_path(PATH_TRANS_TAX, cur, start, end))
 #
@@ -85,25 +729,56 @@ def create_gain_loss_report(rp, start, end, cur, products, enrich=False):
 #
 #     return 0 if len(gain_loss_tax) == 0 else gain_loss_tax['Gain or Loss'].sum()
 
-def merge_tax_reports(start, end):
-    merge_reports(PATH_GL_TAX, 'Tran DT', start, end)
-    merge_reports(PATH_TRANS_TAX, 'created at', start, end)
+def merge_tax_reports(start, end, gl_reports=None, tax_reports=None):
+    """
+    :param gl_reports: per currency gain/loss reports kept in memory by the pipeline, read from the files if None
+    :param tax_reports: per currency tax transactions kept in memory by the pipeline, read from the files if None
+    """
+    merge_reports(PATH_GL_TAX, 'Tran DT', start, end, gl_reports)
+    merge_reports(PATH_TRANS_TAX, 'created at', start, end, tax_reports)
+
+def merge_reports(path, sort_key, start, end, reports=None, streaming=MERGE_STREAMING):
+    """
+    The per currency reports are already sorted by sort_key, the streaming merge writes the total report
+    chunk by chunk instead of concatenating and sorting all of them
+    :param reports: dict of currency and DataFrame, reports are read from path if None
+    """
+    total_path = make_path(path, '', start, end, FILE_NAME_TPL_TOTAL)
+
+    if not streaming:
+        trans = pd.concat(
+            list(reports.values()) if reports is not None else
+            [STORAGE.read(make_path(path, cur, start, end)) for cur, products in CURRENCIES.items()
+             if STORAGE.exists(make_path(path, cur, start, end))],
+            ignore_index=True)
+
+        trans[sort_key] = pd.to_datetime(trans[sort_key])
+        trans = trans.sort_values(by=[sort_key], kind='stable')
+        # the merged reports are the tax deliverable, so they are always exported as csv
+        with metrics.stage('csv_write'):
+            trans.to_csv(total_path, index=False)
+        return
+
+    if reports is not None:
+        sources = [frame_chunks(df, MERGE_CHUNK_SIZE) for df in reports.values()]
+    else:
+        sources = [STORAGE.read_chunks(make_path(path, cur, start, end), MERGE_CHUNK_SIZE)
+                   for cur, products in CURRENCIES.items() if STORAGE.exists(make_path(path, cur, start, end))]
 
-def merge_reports(path, sort_key, start, end):
-    trans = pd.concat(
-        [pd.read_csv(make_path(path, cur, start, end)) for cur, products in CURRENCIES.items()
-         if os.path.exists(make_path(path, cur, start, end))],
-        ignore_index=True)
+    with open(total_path, 'w', newline='') as f:
+        for i, chunk in enumerate(merge_sorted(sources, sort_key)):
+            with metrics.stage('csv_write'):
+                chunk.to_csv(f, index=False, header=i == 0)
 
-    trans[sort_key] = pd.to_datetime(trans[sort_key])
-    trans = trans.sort_values(by=[sort_key])
-    trans.to_csv(make_path(path, '', start, end, FILE_NAME_TPL_TOTAL), index=False)
 
+def write_report(df, path, columns=None):
+    with metrics.stage('report_write'):
+        STORAGE.write(df, path, columns=columns)
 
 
 def make_path(f, c, ds, de, tpl=FILE_NAME_TPL):
     os.makedirs(f, exist_ok=True)
-    return f + tpl.format(c=c, ds=ds.isoformat(), de=de.isoformat())
+    return f + tpl.format(c=c, ds=ds.strftime(FILE_DATE_FMT), de=de.strftime(FILE_DATE_FMT))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of gainloss import each other by their flat names, as main.py is run from that directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,27 @@
+"""
+Open lots checkpoint round trip: lots converted from Coinbase exports are bought on whole seconds, GDAX fills on
+fractions of a second, a checkpoint holding both has to be read back as it was written
+"""
+import pandas as pd
+
+from LotEngine import LotEngine
+from Tran import Tran, GDAX_CLMN
+
+
+def test_checkpoint_mixed_precision_round_trip(tmp_path):
+    engine = LotEngine()
+    engine.add(Tran.open_lot('cb-1', pd.Timestamp('2017-06-23 09:16:48', tz='UTC'), 'BTC', 0.5, 0.5,
+                             2600.0, 1300.0, 0, 'USD', 1.0))
+    engine.add(Tran.open_lot(1234567, pd.Timestamp('2017-06-24 10:00:21.274', tz='UTC'), 'BTC', 0.25, 0.125,
+                             2650.5, 331.3125, 0.79, 'USD', 1.0))
+    checkpoint = engine.checkpoint('BTC')
+    path = str(tmp_path / 'BTC_checkpoint.csv')
+
+    LotEngine.write_checkpoint(checkpoint, path)
+    restored = LotEngine.read_checkpoint(path)
+
+    assert list(restored[GDAX_CLMN.CreatedAt]) == list(checkpoint[GDAX_CLMN.CreatedAt])
+
+    resumed = LotEngine.from_checkpoint(restored, pd.Timestamp('2017-06-30', tz='UTC'))
+    assert resumed.balance('BTC') == engine.balance('BTC')
+    assert resumed.checkpoint('BTC').astype(str).equals(checkpoint.astype(str))
@@ -0,0 +1,40 @@
+"""
+Lot matching regression: the gain/loss and tax gain/loss rows of fixtures/fills.csv, synthetic fills with partial
+fills, maker and taker fees and BTC pairs, are compared as csv text with the ones the original row by row
+get_profit_loss wrote for them
+"""
+import os
+
+import pandas as pd
+import pytest
+
+from ReportProcessor import ReportProcessor
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+START = pd.Timestamp('2017-01-15', tz='UTC')
+END = pd.Timestamp('2017-02-28', tz='UTC')
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return f.read()
+
+
+@pytest.fixture(scope='module')
+def fills():
+    return pd.read_csv(os.path.join(FIXTURES, 'fills.csv'))
+
+
+@pytest.mark.parametrize('currency', ['BTC', 'ETH'])
+def test_gain_loss_rows(fills, currency):
+    gain_loss, gain_loss_tax = ReportProcessor().get_profit_loss(fills, currency, START, END)
+
+    assert gain_loss.to_csv(index=False) == fixture('{c}_gain_loss.csv'.format(c=currency))
+
+
+@pytest.mark.parametrize('currency', ['BTC', 'ETH'])
+def test_tax_rows(fills, currency):
+    gain_loss, gain_loss_tax = ReportProcessor().get_profit_loss(fills, currency, START, END)
+
+    assert gain_loss_tax.to_csv(index=False) == fixture('{c}_tax.csv'.format(c=currency))
@@ -0,0 +1,42 @@
+"""
+merge_sorted against the concat-and-sort merge it replaces: ETH-BTC and LTC-BTC fills are in the reports of two
+currencies with the same timestamps, rows with the same key have to keep the order of the sources across chunks
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from SortedMerge import merge_sorted, frame_chunks
+
+KEY = 'created at'
+
+
+def report(name, days):
+    return pd.DataFrame({KEY: pd.Timestamp('2017-01-01', tz='UTC') + pd.to_timedelta(np.asarray(days), unit='D'),
+                         'row': ['{n}{i}'.format(n=name, i=i) for i in range(len(days))]})
+
+
+def concat_and_sort(reports):
+    return pd.concat(reports, ignore_index=True).sort_values(by=[KEY], kind='stable', ignore_index=True)
+
+
+def merged(reports, chunk_size):
+    return pd.concat(merge_sorted([frame_chunks(r, chunk_size) for r in reports], KEY), ignore_index=True)
+
+
+def test_ties_across_chunk_boundary():
+    reports = [report('a', [1, 2, 2, 3]), report('b', [2, 4])]
+
+    assert list(merged(reports, 2)['row']) == list(concat_and_sort(reports)['row'])
+    assert list(merged(reports, 2)['row']) == ['a0', 'a1', 'a2', 'b0', 'a3', 'b1']
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 100])
+def test_same_order_as_concat_and_sort(chunk_size):
+    rng = np.random.default_rng(chunk_size)
+    reports = [report(name, np.sort(rng.integers(0, 6, rng.integers(0, 20)))) for name in 'abcd']
+
+    result = merged(reports, chunk_size)
+
+    assert list(result['row']) == list(concat_and_sort(reports)['row'])
+    assert result[KEY].equals(concat_and_sort(reports)[KEY])